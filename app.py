@@ -1,1082 +1,2657 @@
-from flask import Flask, render_template_string, request, jsonify, session
+from flask import Flask, render_template, request, jsonify, session, g, Response, abort, make_response
 import uuid
-from datetime import datetime
+from datetime import datetime, timezone
 import os
 import json
 import sqlite3
+import threading
+import time
+import gzip
+import html
+import re
+import hashlib
+import mimetypes
+import functools
+import bisect
+import pickle
+import selectors
+import socket
+import struct
+import sys
+import unicodedata
+import zlib
+from pathlib import Path
+from collections import OrderedDict
+from contextlib import contextmanager
+from flask.json.provider import DefaultJSONProvider
 from flask_socketio import SocketIO, emit, join_room
+from socketio import PubSubManager, RedisManager
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'whatsapp-clone-secure-key'
-socketio = SocketIO(app, cors_allowed_origins="*")
+
+# Database settings (overridable from the environment)
+app.config['DATABASE'] = os.environ.get('DATABASE', 'whatsapp.db')
+app.config['DB_POOL_SIZE'] = int(os.environ.get('DB_POOL_SIZE', 16))
+# FULL fsyncs every commit, so an acknowledged message survives power loss;
+# NORMAL is faster in WAL mode but may lose the last commits
+app.config['DB_SYNCHRONOUS'] = os.environ.get('DB_SYNCHRONOUS', 'FULL')
+app.config['DB_CACHE_SIZE_KB'] = int(os.environ.get('DB_CACHE_SIZE_KB', 16384))
+app.config['DB_MMAP_SIZE'] = int(os.environ.get('DB_MMAP_SIZE', 256 * 1024 * 1024))
+app.config['DB_BUSY_TIMEOUT_MS'] = int(os.environ.get('DB_BUSY_TIMEOUT_MS', 5000))
+app.config['DB_STATEMENT_CACHE'] = int(os.environ.get('DB_STATEMENT_CACHE', 256))
+# Messages are spread over this many SQLite files next to DATABASE, by
+# conversation, so sends to different shards do not share a write lock.
+# Users, friends, conversations and the change log stay in DATABASE. The
+# count is fixed when the database is created.
+app.config['MESSAGE_SHARDS'] = int(os.environ.get('MESSAGE_SHARDS', 4))
+# Cold storage: whole months of messages older than ARCHIVE_AFTER_DAYS move
+# out of the shards into one compressed, read-only segment file per month,
+# checked every ARCHIVE_INTERVAL seconds (0 days turns archiving off).
+# Decompressed blocks of archived messages are cached on demand.
+app.config['ARCHIVE_AFTER_DAYS'] = float(os.environ.get('ARCHIVE_AFTER_DAYS', 180))
+app.config['ARCHIVE_INTERVAL'] = float(os.environ.get('ARCHIVE_INTERVAL', 3600))
+app.config['ARCHIVE_CACHE_BLOCKS'] = int(os.environ.get('ARCHIVE_CACHE_BLOCKS', 2000))
+# Native threads that run sqlite3 calls under eventlet (0 runs them inline)
+app.config['DB_THREADPOOL_SIZE'] = int(os.environ.get('DB_THREADPOOL_SIZE', 8))
+
+# Group commit for message inserts
+app.config['MESSAGE_BATCH_SIZE'] = int(os.environ.get('MESSAGE_BATCH_SIZE', 64))
+app.config['MESSAGE_BATCH_LATENCY_MS'] = float(os.environ.get('MESSAGE_BATCH_LATENCY_MS', 5))
+
+# JSON responses at least this large are gzipped when the client accepts it
+app.config['JSON_COMPRESS_MIN_SIZE'] = int(os.environ.get('JSON_COMPRESS_MIN_SIZE', 1024))
+app.config['JSON_COMPRESS_LEVEL'] = int(os.environ.get('JSON_COMPRESS_LEVEL', 6))
+
+# Hot-conversation cache: newest messages kept per conversation, how many
+# conversations to keep, and a rough memory cap across all of them
+app.config['MESSAGE_CACHE_SIZE'] = int(os.environ.get('MESSAGE_CACHE_SIZE', 100))
+app.config['MESSAGE_CACHE_CONVERSATIONS'] = int(os.environ.get('MESSAGE_CACHE_CONVERSATIONS', 1000))
+app.config['MESSAGE_CACHE_MAX_BYTES'] = int(os.environ.get('MESSAGE_CACHE_MAX_BYTES', 32 * 1024 * 1024))
+
+# Read-through caches for user rows and conversation membership
+app.config['USER_CACHE_SIZE'] = int(os.environ.get('USER_CACHE_SIZE', 10000))
+app.config['USER_CACHE_TTL'] = float(os.environ.get('USER_CACHE_TTL', 60))
+app.config['PARTICIPANT_CACHE_SIZE'] = int(os.environ.get('PARTICIPANT_CACHE_SIZE', 10000))
+app.config['PARTICIPANT_CACHE_TTL'] = float(os.environ.get('PARTICIPANT_CACHE_TTL', 60))
+
+# How often in-memory presence is written back to users.online / last_seen
+app.config['PRESENCE_FLUSH_INTERVAL'] = float(os.environ.get('PRESENCE_FLUSH_INTERVAL', 5))
+# Online/offline pushes to friends: a change must hold for the debounce
+# delay before it is sent, and each user is broadcast at most once per
+# min interval, so a flapping mobile connection stays quiet
+app.config['PRESENCE_BROADCAST_DELAY'] = float(os.environ.get('PRESENCE_BROADCAST_DELAY', 2))
+app.config['PRESENCE_BROADCAST_MIN_INTERVAL'] = float(os.environ.get('PRESENCE_BROADCAST_MIN_INTERVAL', 5))
+
+# Typing indicators: at most one event per user and conversation per min
+# interval; an ongoing "typing" is re-sent every refresh interval
+app.config['TYPING_MIN_INTERVAL'] = float(os.environ.get('TYPING_MIN_INTERVAL', 1))
+app.config['TYPING_REFRESH_INTERVAL'] = float(os.environ.get('TYPING_REFRESH_INTERVAL', 3))
+
+# Delivered/read receipts are merged for this long before one write and emit
+app.config['RECEIPT_FLUSH_INTERVAL'] = float(os.environ.get('RECEIPT_FLUSH_INTERVAL', 1))
+
+# Socket.IO packet encoding: 'default' (JSON) or 'msgpack' for binary frames.
+# msgpack needs the msgpack package and a client using socket.io-msgpack-parser;
+# the bundled web client speaks the default JSON parser.
+app.config['SOCKETIO_SERIALIZER'] = os.environ.get('SOCKETIO_SERIALIZER', 'default')
+
+# Socket.IO transport profile. Clients try the transports in this order;
+# 'websocket' alone skips long-polling entirely (and with it the need for
+# sticky sessions). The ping timeout is generous so a phone whose radio is
+# waking up or a briefly backgrounded tab is not dropped.
+app.config['SOCKETIO_TRANSPORTS'] = os.environ.get('SOCKETIO_TRANSPORTS', 'websocket,polling').split(',')
+app.config['SOCKETIO_PING_INTERVAL'] = float(os.environ.get('SOCKETIO_PING_INTERVAL', 25))
+app.config['SOCKETIO_PING_TIMEOUT'] = float(os.environ.get('SOCKETIO_PING_TIMEOUT', 30))
+app.config['SOCKETIO_CONNECT_TIMEOUT_MS'] = int(os.environ.get('SOCKETIO_CONNECT_TIMEOUT_MS', 10000))
+# Largest packet a client may send (also the websocket frame limit)
+app.config['SOCKETIO_MAX_BUFFER_SIZE'] = int(os.environ.get('SOCKETIO_MAX_BUFFER_SIZE', 256 * 1024))
+# permessage-deflate / polling gzip for packets at least this large
+app.config['SOCKETIO_COMPRESSION'] = os.environ.get('SOCKETIO_COMPRESSION', '1') != '0'
+app.config['SOCKETIO_COMPRESSION_THRESHOLD'] = int(os.environ.get('SOCKETIO_COMPRESSION_THRESHOLD', 1024))
+
+# JSON serialization
+# orjson is used when installed, the stdlib encoder otherwise. Both accept
+# sqlite3.Row directly so query results need no per-row dict() copy.
+def json_default(obj):
+    if isinstance(obj, sqlite3.Row):
+        return dict(obj)
+    return DefaultJSONProvider.default(obj)
+
+class FastJSONProvider(DefaultJSONProvider):
+    sort_keys = False
+
+    def dumps(self, obj, **kwargs):
+        if orjson is not None and not kwargs.get('indent'):
+            return orjson.dumps(obj, default=json_default).decode('utf-8')
+        kwargs.setdefault('default', json_default)
+        return super().dumps(obj, **kwargs)
+
+    def loads(self, s, **kwargs):
+        if orjson is not None and not kwargs:
+            return orjson.loads(s)
+        return super().loads(s, **kwargs)
+
+    def response(self, *args, **kwargs):
+        if orjson is None or self.compact is False or (self.compact is None and self._app.debug):
+            return super().response(*args, **kwargs)
+        # Encode straight to bytes; no intermediate str
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            orjson.dumps(obj, default=json_default, option=orjson.OPT_APPEND_NEWLINE),
+            mimetype=self.mimetype)
+
+app.json = FastJSONProvider(app)
+
+class SocketJSON:
+    # json-module lookalike used by python-socketio / python-engineio packets
+    @staticmethod
+    def dumps(obj, **kwargs):
+        if orjson is not None:
+            return orjson.dumps(obj, default=json_default).decode('utf-8')
+        return json.dumps(obj, default=json_default, **kwargs)
+
+    @staticmethod
+    def loads(s, **kwargs):
+        if orjson is not None:
+            return orjson.loads(s)
+        return json.loads(s, **kwargs)
+
+# Multi-process bridge
+# With several worker processes, emits (and the app's own cross-worker
+# messages) travel through a message queue. 'local:///path/to.sock' uses the
+# built-in broker (python app.py broker /path/to.sock), 'redis://...' uses
+# Redis. Unset means a single process.
+app.config['SOCKETIO_MESSAGE_QUEUE'] = os.environ.get('SOCKETIO_MESSAGE_QUEUE')
+
+def write_frame(sock, payload):
+    sock.sendall(struct.pack('>I', len(payload)) + payload)
+
+def read_frames(buffer):
+    # Split complete length-prefixed frames off the front of a bytearray
+    frames = []
+    while len(buffer) >= 4:
+        size = struct.unpack('>I', buffer[:4])[0]
+        if len(buffer) < 4 + size:
+            break
+        frames.append(bytes(buffer[4:4 + size]))
+        del buffer[:4 + size]
+    return frames
+
+class LocalBroker:
+    # Fan-out hub over a Unix socket, so workers on one box can share
+    # Socket.IO traffic without Redis. A connection starts with one role
+    # byte: b'P' publishes frames, b'S' receives every published frame.
+    MAX_BACKLOG = 64 * 1024 * 1024
+
+    def __init__(self, path):
+        self.path = path
+        self._selector = selectors.DefaultSelector()
+        self._clients = {}  # socket -> {'role', 'in', 'out'}
+
+    def serve_forever(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.path)
+        server.listen(128)
+        server.setblocking(False)
+        self._selector.register(server, selectors.EVENT_READ)
+        print(f"Pub/sub broker listening on {self.path}")
+        while True:
+            for key, events in self._selector.select():
+                if key.fileobj is server:
+                    conn, _ = server.accept()
+                    conn.setblocking(False)
+                    self._clients[conn] = {'role': None, 'in': bytearray(), 'out': bytearray()}
+                    self._selector.register(conn, selectors.EVENT_READ)
+                    continue
+                if events & selectors.EVENT_READ:
+                    self._read(key.fileobj)
+                if events & selectors.EVENT_WRITE and key.fileobj in self._clients:
+                    self._write(key.fileobj)
+
+    def _drop(self, conn):
+        self._clients.pop(conn, None)
+        self._selector.unregister(conn)
+        conn.close()
+
+    def _read(self, conn):
+        try:
+            data = conn.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self._drop(conn)
+            return
+        client = self._clients[conn]
+        if client['role'] is None:
+            client['role'], data = data[:1], data[1:]
+        client['in'] += data
+        for frame in read_frames(client['in']):
+            self._broadcast(struct.pack('>I', len(frame)) + frame)
+
+    def _broadcast(self, payload):
+        for conn, client in list(self._clients.items()):
+            if client['role'] != b'S':
+                continue
+            if len(client['out']) > self.MAX_BACKLOG:
+                # A subscriber that stopped reading would hold memory forever
+                self._drop(conn)
+                continue
+            if not client['out']:
+                self._selector.modify(conn, selectors.EVENT_READ | selectors.EVENT_WRITE)
+            client['out'] += payload
+
+    def _write(self, conn):
+        client = self._clients[conn]
+        try:
+            sent = conn.send(client['out'])
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            self._drop(conn)
+            return
+        del client['out'][:sent]
+        if not client['out']:
+            self._selector.modify(conn, selectors.EVENT_READ)
+
+def plain(obj):
+    # sqlite3.Row cannot be pickled or msgpacked; turn rows in a payload
+    # into dicts (socket emits and cluster messages)
+    if isinstance(obj, sqlite3.Row):
+        return dict(obj)
+    if isinstance(obj, dict):
+        return {key: plain(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [plain(value) for value in obj]
+    return obj
+
+class AppMessageBridge:
+    # Mixin for PubSubManager backends: carries the app's own cross-worker
+    # messages ({'method': 'app'}) next to Socket.IO's. They are dispatched
+    # to `cluster` and never reach the Socket.IO listener.
+    def publish_app(self, kind, payload):
+        self._publish({'method': 'app', 'kind': kind, 'payload': payload, 'host_id': self.host_id})
+
+    def _publish(self, data):
+        return super()._publish(plain(data))
+
+    def _listen(self):
+        for message in super()._listen():
+            data = message
+            if isinstance(message, bytes):
+                try:
+                    data = pickle.loads(message)
+                except Exception:
+                    continue
+            if isinstance(data, dict) and data.get('method') == 'app':
+                if data.get('host_id') != self.host_id:
+                    cluster.dispatch(data['host_id'], data['kind'], data['payload'])
+                continue
+            yield data
+
+class LocalPubSubManager(PubSubManager):
+    # Client manager for the built-in LocalBroker
+    name = 'local'
+
+    def __init__(self, path, channel='socketio', write_only=False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.path = path
+        self._outbox = None
+
+    def _socket_module(self):
+        if self.server.async_mode == 'eventlet':
+            from eventlet.green import socket as green_socket
+            return green_socket
+        return socket
+
+    def _connect(self, role):
+        module = self._socket_module()
+        sock = module.socket(module.AF_UNIX, module.SOCK_STREAM)
+        sock.connect(self.path)
+        sock.sendall(role)
+        return sock
+
+    def initialize(self):
+        super().initialize()
+        # A single writer task owns the publish connection, so frames from
+        # concurrent emitters never interleave
+        self._outbox = self.server.eio.create_queue()
+        self.server.start_background_task(self._writer)
+
+    def _publish(self, data):
+        self._outbox.put(pickle.dumps(data))
+
+    def _writer(self):
+        sock = None
+        while True:
+            payload = self._outbox.get()
+            for _ in range(2):
+                try:
+                    if sock is None:
+                        sock = self._connect(b'P')
+                    write_frame(sock, payload)
+                    break
+                except OSError as e:
+                    sock = None
+                    self._get_logger().error(f"Pub/sub publish to {self.path} failed: {e}")
+
+    def _listen(self):
+        retry = 1
+        while True:
+            try:
+                sock = self._connect(b'S')
+                retry = 1
+                buffer = bytearray()
+                while True:
+                    chunk = sock.recv(65536)
+                    if not chunk:
+                        raise OSError('broker closed the connection')
+                    buffer += chunk
+                    for frame in read_frames(buffer):
+                        yield frame
+            except OSError as e:
+                self._get_logger().error(f"Pub/sub broker {self.path} unavailable ({e}), retrying in {retry}s")
+                self.server.sleep(retry)
+                retry = min(retry * 2, 30)
+
+class LocalBridgeManager(AppMessageBridge, LocalPubSubManager):
+    pass
+
+class RedisBridgeManager(AppMessageBridge, RedisManager):
+    pass
+
+def create_client_manager(url):
+    if not url:
+        return None
+    if url.startswith('local://'):
+        return LocalBridgeManager(url[len('local://'):])
+    if url.startswith(('redis://', 'rediss://')):
+        return RedisBridgeManager(url)
+    raise ValueError(f"Unsupported SOCKETIO_MESSAGE_QUEUE: {url}")
+
+class Cluster:
+    # Cross-worker coordination on top of the client manager. In a single
+    # process publish() is a no-op and everything stays local.
+    def __init__(self):
+        self.manager = None
+        self._handlers = {}
+
+    @property
+    def enabled(self):
+        return self.manager is not None
+
+    @property
+    def host_id(self):
+        return self.manager.host_id if self.manager is not None else None
+
+    def on(self, kind):
+        def decorator(handler):
+            self._handlers[kind] = handler
+            return handler
+        return decorator
+
+    def start(self):
+        # python-socketio initializes the manager on first use; do it up front
+        # so this worker listens (and can publish) before any socket connects
+        server = socketio.server
+        if self.manager is not None and not server.manager_initialized:
+            server.manager_initialized = True
+            self.manager.initialize()
+
+    def publish(self, kind, payload):
+        if self.manager is not None:
+            self.start()
+            self.manager.publish_app(kind, payload)
+
+    def dispatch(self, host_id, kind, payload):
+        handler = self._handlers.get(kind)
+        if handler is None:
+            return
+        try:
+            handler(host_id, payload)
+        except Exception as e:
+            print(f"Cluster message {kind} failed: {e}")
+
+cluster = Cluster()
+cluster.manager = create_client_manager(app.config['SOCKETIO_MESSAGE_QUEUE'])
+
+socketio = SocketIO(app, cors_allowed_origins="*", json=SocketJSON,
+                    serializer=app.config['SOCKETIO_SERIALIZER'],
+                    client_manager=cluster.manager,
+                    transports=app.config['SOCKETIO_TRANSPORTS'],
+                    ping_interval=app.config['SOCKETIO_PING_INTERVAL'],
+                    ping_timeout=app.config['SOCKETIO_PING_TIMEOUT'],
+                    max_http_buffer_size=app.config['SOCKETIO_MAX_BUFFER_SIZE'],
+                    http_compression=app.config['SOCKETIO_COMPRESSION'],
+                    compression_threshold=app.config['SOCKETIO_COMPRESSION_THRESHOLD'])
+
+# WebSocket compression
+# Eventlet accepts permessage-deflate whenever the browser offers it and then
+# deflates every frame. Honour SOCKETIO_COMPRESSION and leave frames below the
+# threshold uncompressed (RFC 7692 allows that per message): small packets
+# like pings and acks cost more CPU to deflate than they save.
+if socketio.async_mode == 'eventlet':
+    from eventlet.websocket import RFC6455WebSocket
+    from engineio.async_drivers.eventlet import WebSocketWSGI
+
+    class ThresholdDeflateWebSocket(RFC6455WebSocket):
+        def _pack_message(self, message, *args, **kwargs):
+            self._skip_deflate = len(message) < app.config['SOCKETIO_COMPRESSION_THRESHOLD']
+            return super()._pack_message(message, *args, **kwargs)
+
+        def _get_permessage_deflate_enc(self):
+            if getattr(self, '_skip_deflate', False):
+                return None
+            return super()._get_permessage_deflate_enc()
+
+    class DeflateWebSocketWSGI(WebSocketWSGI):
+        def __call__(self, environ, start_response):
+            if not app.config['SOCKETIO_COMPRESSION']:
+                environ.pop('HTTP_SEC_WEBSOCKET_EXTENSIONS', None)
+            return super().__call__(environ, start_response)
+
+        def _handle_hybi_request(self, environ):
+            ws = super()._handle_hybi_request(environ)
+            if isinstance(ws, RFC6455WebSocket):
+                ws.__class__ = ThresholdDeflateWebSocket
+            return ws
+
+    socketio.server.eio._async = dict(socketio.server.eio._async, websocket=DeflateWebSocketWSGI)
+
+def client_socket_options():
+    # The same profile for connectSocket() in static/app.js
+    transports = app.config['SOCKETIO_TRANSPORTS']
+    return {
+        'transports': transports,
+        'tryAllTransports': len(transports) > 1,
+        'timeout': app.config['SOCKETIO_CONNECT_TIMEOUT_MS']
+    }
+
+# Database executor
+class DBExecutor:
+    # sqlite3 calls are blocking C calls; under eventlet they would stall the
+    # hub and every socket with it. Run them on eventlet's bounded pool of
+    # native threads instead and keep counters for how deep the queue gets.
+    def __init__(self, threads):
+        self.enabled = threads > 0 and socketio.async_mode == 'eventlet'
+        self.threads = threads
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.completed = 0
+        self.total_time = 0.0
+        if self.enabled:
+            from eventlet import tpool
+            tpool.set_num_threads(threads)
+            self._execute = tpool.execute
+
+    def run(self, fn, *args):
+        if not self.enabled:
+            return fn(*args)
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        started = time.monotonic()
+        try:
+            return self._execute(fn, *args)
+        finally:
+            self.in_flight -= 1
+            self.completed += 1
+            self.total_time += time.monotonic() - started
+
+    def stats(self):
+        return {
+            'offloaded': self.enabled,
+            'threads': self.threads,
+            'in_flight': self.in_flight,
+            'queued': max(0, self.in_flight - self.threads),
+            'peak_in_flight': self.peak_in_flight,
+            'completed': self.completed,
+            'avg_ms': round(self.total_time * 1000 / self.completed, 3) if self.completed else 0.0
+        }
+
+db_executor = DBExecutor(app.config['DB_THREADPOOL_SIZE'])
+
+class BufferedCursor:
+    # Rows are fetched on the worker thread so reading them never blocks
+    def __init__(self, cursor):
+        self.description = cursor.description
+        self.rowcount = cursor.rowcount
+        self.lastrowid = cursor.lastrowid
+        self._rows = cursor.fetchall() if cursor.description else []
+        self._pos = 0
+
+    def fetchone(self):
+        if self._pos >= len(self._rows):
+            return None
+        self._pos += 1
+        return self._rows[self._pos - 1]
+
+    def fetchall(self):
+        rows = self._rows[self._pos:]
+        self._pos = len(self._rows)
+        return rows
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+class Connection:
+    # sqlite3 connection whose calls go through the database executor
+    def __init__(self, conn):
+        self._conn = conn
+
+    @property
+    def in_transaction(self):
+        return self._conn.in_transaction
+
+    def execute(self, sql, params=()):
+        return db_executor.run(lambda: BufferedCursor(self._conn.execute(sql, params)))
+
+    def executemany(self, sql, seq):
+        return db_executor.run(lambda: BufferedCursor(self._conn.executemany(sql, seq)))
+
+    def commit(self):
+        db_executor.run(self._conn.commit)
+
+    def rollback(self):
+        db_executor.run(self._conn.rollback)
+
+    def close(self):
+        self._conn.close()
+
+# Connection pool
+class ConnectionPool:
+    # Keeps up to `size` idle connections around so requests reuse an open
+    # handle (and its statement cache) instead of reconnecting every time.
+    # Acquire never blocks: when the pool is empty a new connection is opened,
+    # and surplus connections are closed on release.
+    def __init__(self, path, size=16, synchronous='FULL', cache_size_kb=16384,
+                 mmap_size=0, busy_timeout_ms=5000, statement_cache=256, readonly=False):
+        self.path = path
+        self.readonly = readonly
+        self.size = size
+        self.synchronous = synchronous
+        self.cache_size_kb = cache_size_kb
+        self.mmap_size = mmap_size
+        self.busy_timeout_ms = busy_timeout_ms
+        self.statement_cache = statement_cache
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self.readonly:
+            # Sealed files (archive segments) are never written, so skip
+            # journaling and locking altogether
+            conn = sqlite3.connect(Path(self.path).absolute().as_uri() + '?mode=ro&immutable=1', uri=True,
+                                   check_same_thread=False, cached_statements=self.statement_cache)
+            conn.row_factory = sqlite3.Row
+            conn.execute(f'PRAGMA cache_size = -{self.cache_size_kb}')
+            return Connection(conn)
+        conn = sqlite3.connect(self.path,
+                               timeout=self.busy_timeout_ms / 1000.0,
+                               check_same_thread=False,
+                               cached_statements=self.statement_cache)
+        conn.row_factory = sqlite3.Row
+        # WAL lets readers proceed while a writer is active
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute(f'PRAGMA synchronous = {self.synchronous}')
+        conn.execute(f'PRAGMA cache_size = -{self.cache_size_kb}')
+        conn.execute(f'PRAGMA mmap_size = {self.mmap_size}')
+        conn.execute(f'PRAGMA busy_timeout = {self.busy_timeout_ms}')
+        conn.execute('PRAGMA temp_store = MEMORY')
+        return Connection(conn)
+
+    def acquire(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return db_executor.run(self._connect)
+
+    def release(self, conn):
+        # Never hand out a connection with a half-finished transaction
+        if conn.in_transaction:
+            conn.rollback()
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+db_pool = ConnectionPool(app.config['DATABASE'],
+                         size=app.config['DB_POOL_SIZE'],
+                         synchronous=app.config['DB_SYNCHRONOUS'],
+                         cache_size_kb=app.config['DB_CACHE_SIZE_KB'],
+                         mmap_size=app.config['DB_MMAP_SIZE'],
+                         busy_timeout_ms=app.config['DB_BUSY_TIMEOUT_MS'],
+                         statement_cache=app.config['DB_STATEMENT_CACHE'])
+
+# Message shards
+class MessageShards:
+    # Messages (and their search index) live in `count` SQLite files, each
+    # with its own connection pool and write lock. A conversation always maps
+    # to the same shard, so its history is read from one file; queries over
+    # many conversations ask each shard involved once.
+    def __init__(self, path, count, **pool_options):
+        self.count = max(1, count)
+        root, ext = os.path.splitext(path)
+        self.paths = [f'{root}-messages-{index}{ext or ".db"}' for index in range(self.count)]
+        self.pools = [ConnectionPool(shard_path, **pool_options) for shard_path in self.paths]
+
+    def index(self, conversation_id):
+        # crc32 rather than hash(): str hashes differ between processes
+        return zlib.crc32((conversation_id or '').encode('utf-8')) % self.count
+
+    def connection(self, conversation_id):
+        return self.pools[self.index(conversation_id)].connection()
+
+    def group(self, items, key):
+        # {shard index: [item, ...]} for items keyed by conversation id
+        groups = {}
+        for item in items:
+            groups.setdefault(self.index(key(item)), []).append(item)
+        return groups
+
+    def close_all(self):
+        for pool in self.pools:
+            pool.close_all()
+
+message_shards = MessageShards(app.config['DATABASE'], app.config['MESSAGE_SHARDS'],
+                               size=app.config['DB_POOL_SIZE'],
+                               synchronous=app.config['DB_SYNCHRONOUS'],
+                               cache_size_kb=app.config['DB_CACHE_SIZE_KB'],
+                               mmap_size=app.config['DB_MMAP_SIZE'],
+                               busy_timeout_ms=app.config['DB_BUSY_TIMEOUT_MS'],
+                               statement_cache=app.config['DB_STATEMENT_CACHE'])
+
+# Identifiers
+# Messages, friend requests, calls and new conversations get 64-bit ids that
+# sort by creation time: 41 bits of milliseconds since ID_EPOCH_MS, 10 bits
+# of node and 12 bits of sequence. Stored as INTEGER keys, new rows land at
+# the end of the B-tree instead of at random positions. Clients get them as
+# decimal strings, since JavaScript numbers only hold 53 bits.
+ID_EPOCH_MS = 1577836800000  # 2020-01-01T00:00:00Z
+ID_NODE_BITS = 10
+ID_SEQUENCE_BITS = 12
+
+class IdGenerator:
+    # Ids from one node are strictly increasing. If the clock steps back the
+    # last millisecond is reused, and a full sequence borrows the next one.
+    def __init__(self, node=None):
+        self.node = node
+        self._last_ms = 0
+        self._sequence = 0
+        self._lock = threading.Lock()
+
+    def next(self, at_ms=None):
+        if self.node is None:
+            self.node = claim_id_node()
+        with self._lock:
+            ms = max(int(time.time() * 1000) if at_ms is None else at_ms, ID_EPOCH_MS, self._last_ms)
+            if ms == self._last_ms:
+                self._sequence += 1
+                if self._sequence >> ID_SEQUENCE_BITS:
+                    ms += 1
+                    self._sequence = 0
+            else:
+                self._sequence = 0
+            self._last_ms = ms
+            return (((ms - ID_EPOCH_MS) << (ID_NODE_BITS + ID_SEQUENCE_BITS))
+                    | (self.node << ID_SEQUENCE_BITS) | self._sequence)
+
+def claim_id_node():
+    # Every process takes the next node number from the main database, so
+    # workers never share one (numbers wrap after 1024 claims)
+    with db_pool.connection() as db:
+        row = db.execute('''INSERT INTO settings (key, value) VALUES ('id_node', 0)
+                            ON CONFLICT (key) DO UPDATE SET value = (value + 1) % ?
+                            RETURNING value''', (1 << ID_NODE_BITS,)).fetchone()
+        db.commit()
+    return int(row['value'])
+
+def parse_id(value):
+    # Ids arrive as decimal strings; anything else (e.g. an old uuid) is None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def id_ms(value):
+    # Milliseconds (Unix time) at which an id was generated
+    return (int(value) >> (ID_NODE_BITS + ID_SEQUENCE_BITS)) + ID_EPOCH_MS
+
+def id_at_ms(ms):
+    # Smallest id that can be generated at `ms`
+    return max(0, ms - ID_EPOCH_MS) << (ID_NODE_BITS + ID_SEQUENCE_BITS)
+
+def id_datetime(value):
+    return datetime.fromtimestamp(id_ms(value) / 1000, timezone.utc)
+
+def id_timestamp(value):
+    # UTC in the client's toISOString() form, so stored timestamps compare
+    # correctly as text whichever side produced them
+    return id_datetime(value).strftime('%Y-%m-%dT%H:%M:%S.') + f'{id_ms(value) % 1000:03d}Z'
+
+def timestamp_ms(value):
+    # Milliseconds for a stored ISO timestamp, 0 when it cannot be parsed
+    try:
+        return int(datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp() * 1000)
+    except (AttributeError, ValueError):
+        return 0
+
+id_generator = IdGenerator()
+
+# Schema migrations
+# Each entry upgrades the schema by one version, tracked in PRAGMA user_version.
+# Steps are SQL strings or callables taking the connection. Only append new
+# migrations; never edit one that has already shipped.
+MESSAGE_COLUMNS = 'id, conversation_id, user_id, content, message_type, timestamp, status, seq'
+
+def move_messages_to_shards(conn):
+    # Copy messages into their shards in rowid chunks, then build each
+    # shard's search index from its rows. The copies ignore rows that are
+    # already there, so an upgrade that was interrupted can simply rerun.
+    last_rowid = 0
+    while True:
+        rows = conn.execute(f'SELECT rowid, {MESSAGE_COLUMNS} FROM messages WHERE rowid > ? ORDER BY rowid LIMIT 5000',
+                            (last_rowid,)).fetchall()
+        if not rows:
+            break
+        last_rowid = rows[-1]['rowid']
+        for index, chunk in message_shards.group(rows, lambda row: row['conversation_id']).items():
+            with message_shards.pools[index].connection() as shard:
+                shard.executemany(f'INSERT OR IGNORE INTO messages ({MESSAGE_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                                  [tuple(row)[1:] for row in chunk])
+                shard.commit()
+    for pool in message_shards.pools:
+        with pool.connection() as shard:
+            shard.execute('DELETE FROM messages_fts')
+            shard.execute('''INSERT INTO messages_fts (content, conversation_id, message_id)
+                             SELECT content, conversation_id, id FROM messages''')
+            shard.commit()
+    conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('message_shards', ?)",
+                 (str(message_shards.count),))
+
+def upgrade_shards(version):
+    # Migration step that first brings every shard to `version`, for main
+    # migrations that depend on a shard schema change
+    def step(conn):
+        for index, pool in enumerate(message_shards.pools):
+            with pool.connection() as shard:
+                migrate(shard, SHARD_MIGRATIONS, f'shard {index}', target=version)
+    return step
+
+def legacy_ids(rows):
+    # Ids for renumbered rows, given as (old id, timestamp, node) in the
+    # order they should keep. Timestamps are capped at the time of the
+    # upgrade, so these ids can never collide with ones generated later.
+    now_ms = int(time.time() * 1000)
+    generators = {}
+    mapping = []
+    for legacy_id, timestamp, node in rows:
+        generator = generators.setdefault(node, IdGenerator(node))
+        mapping.append((legacy_id, generator.next(min(timestamp_ms(timestamp), now_ms))))
+    return mapping
+
+def renumber_messages(shard):
+    # Node is the shard number, which keeps the shards' ids apart
+    rows = shard.execute('SELECT id, timestamp, conversation_id FROM messages ORDER BY timestamp, id').fetchall()
+    mapping = legacy_ids([(row['id'], row['timestamp'], message_shards.index(row['conversation_id']))
+                          for row in rows])
+    shard.executemany('INSERT INTO legacy_message_ids (legacy_id, id) VALUES (?, ?)', mapping)
+
+def remap_message_references(conn):
+    # Point the change log and last-message columns at renumbered messages
+    conn.execute('CREATE TEMP TABLE message_id_map (legacy_id TEXT PRIMARY KEY, id INTEGER)')
+    for pool in message_shards.pools:
+        with pool.connection() as shard:
+            rows = shard.execute('SELECT legacy_id, id FROM legacy_message_ids').fetchall()
+        conn.executemany('INSERT OR IGNORE INTO temp.message_id_map (legacy_id, id) VALUES (?, ?)',
+                         [tuple(row) for row in rows])
+    conn.execute('''UPDATE changes SET entity_id = CAST(m.id AS TEXT)
+                    FROM temp.message_id_map m
+                    WHERE changes.kind = 'message' AND changes.entity_id = m.legacy_id''')
+    conn.execute('''UPDATE conversations SET last_message_id = CAST(m.id AS TEXT)
+                    FROM temp.message_id_map m
+                    WHERE conversations.last_message_id = m.legacy_id''')
+    conn.execute('DROP TABLE temp.message_id_map')
+
+def renumber_table(table, columns, change_kind=None):
+    # Migration step: copy `table` into `{table}_v2` (created just before with
+    # an INTEGER id) under ids in created_at order, and point change-log
+    # entries of `change_kind` at the new ids
+    def step(conn):
+        rows = conn.execute(f'SELECT id, created_at FROM {table} ORDER BY created_at, id').fetchall()
+        conn.execute('CREATE TEMP TABLE id_map (legacy_id TEXT PRIMARY KEY, id INTEGER)')
+        conn.executemany('INSERT INTO temp.id_map (legacy_id, id) VALUES (?, ?)',
+                         legacy_ids([(row['id'], row['created_at'], 0) for row in rows]))
+        conn.execute(f'''INSERT INTO {table}_v2 (id, {', '.join(columns)})
+                         SELECT m.id, {', '.join('t.' + column for column in columns)}
+                         FROM {table} t JOIN temp.id_map m ON m.legacy_id = t.id''')
+        if change_kind:
+            conn.execute('''UPDATE changes SET entity_id = CAST(m.id AS TEXT)
+                            FROM temp.id_map m
+                            WHERE changes.kind = ? AND changes.entity_id = m.legacy_id''', (change_kind,))
+        conn.execute('DROP TABLE temp.id_map')
+    return step
+
+MIGRATIONS = [
+    # 1: base tables (IF NOT EXISTS so databases created before versioning adopt it)
+    [
+        '''CREATE TABLE IF NOT EXISTS users
+           (id TEXT PRIMARY KEY, username TEXT UNIQUE, display_name TEXT,
+            user_code TEXT UNIQUE, online INTEGER DEFAULT 0, last_seen TEXT,
+            avatar_color TEXT, created_at TEXT)''',
+        '''CREATE TABLE IF NOT EXISTS friend_requests
+           (id TEXT PRIMARY KEY, from_user_id TEXT, to_user_id TEXT,
+            status TEXT DEFAULT 'pending', created_at TEXT)''',
+        '''CREATE TABLE IF NOT EXISTS friends
+           (user_id TEXT, friend_id TEXT, created_at TEXT,
+            PRIMARY KEY (user_id, friend_id))''',
+        '''CREATE TABLE IF NOT EXISTS conversations
+           (id TEXT PRIMARY KEY, name TEXT, is_group INTEGER DEFAULT 0,
+            created_by TEXT, created_at TEXT)''',
+        '''CREATE TABLE IF NOT EXISTS conversation_participants
+           (conversation_id TEXT, user_id TEXT,
+            PRIMARY KEY (conversation_id, user_id))''',
+        '''CREATE TABLE IF NOT EXISTS messages
+           (id TEXT PRIMARY KEY, conversation_id TEXT, user_id TEXT,
+            content TEXT, message_type TEXT DEFAULT 'text',
+            timestamp TEXT, status TEXT DEFAULT 'sent')''',
+        '''CREATE TABLE IF NOT EXISTS active_calls
+           (id TEXT PRIMARY KEY, from_user_id TEXT, to_user_id TEXT,
+            conversation_id TEXT, call_type TEXT, status TEXT,
+            created_at TEXT)''',
+    ],
+    # 2: hot-path indexes
+    [
+        # api_messages: WHERE conversation_id = ? ORDER BY timestamp
+        '''CREATE INDEX IF NOT EXISTS idx_messages_conversation_timestamp
+           ON messages (conversation_id, timestamp)''',
+        # api_conversations / api_create_conversation: WHERE cp.user_id = ?
+        # (the primary key already covers lookups by conversation_id)
+        '''CREATE INDEX IF NOT EXISTS idx_participants_user
+           ON conversation_participants (user_id, conversation_id)''',
+        # api_friend_requests: WHERE to_user_id = ? AND status = 'pending'
+        '''CREATE INDEX IF NOT EXISTS idx_friend_requests_to_status
+           ON friend_requests (to_user_id, status, from_user_id)''',
+        # api_send_friend_request duplicate check
+        '''CREATE INDEX IF NOT EXISTS idx_friend_requests_from_to_status
+           ON friend_requests (from_user_id, to_user_id, status)''',
+        # api_friends: WHERE f.user_id = ? is served by the primary key;
+        # users.username and users.user_code are UNIQUE and already indexed.
+    ],
+    # 3: denormalized last message on conversations (maintained on every send)
+    [
+        'ALTER TABLE conversations ADD COLUMN last_message_id TEXT',
+        'ALTER TABLE conversations ADD COLUMN last_message_preview TEXT',
+        'ALTER TABLE conversations ADD COLUMN last_message_at TEXT',
+        '''UPDATE conversations SET
+               last_message_id = (SELECT id FROM messages WHERE conversation_id = conversations.id
+                                  ORDER BY timestamp DESC LIMIT 1),
+               last_message_preview = (SELECT substr(content, 1, 120) FROM messages
+                                       WHERE conversation_id = conversations.id
+                                       ORDER BY timestamp DESC LIMIT 1),
+               last_message_at = (SELECT MAX(timestamp) FROM messages
+                                  WHERE conversation_id = conversations.id)''',
+    ],
+    # 4: keyset pagination index for api_messages (timestamp, id) cursors
+    [
+        '''CREATE INDEX IF NOT EXISTS idx_messages_conversation_timestamp_id
+           ON messages (conversation_id, timestamp, id)''',
+        'DROP INDEX IF EXISTS idx_messages_conversation_timestamp',
+    ],
+    # 5: change log for /api/sync. Each row is scoped either to one user or to
+    # a conversation (seen by all of its participants).
+    [
+        '''CREATE TABLE IF NOT EXISTS changes
+           (seq INTEGER PRIMARY KEY AUTOINCREMENT, scope TEXT, scope_id TEXT,
+            kind TEXT, entity_id TEXT)''',
+        '''CREATE INDEX IF NOT EXISTS idx_changes_scope
+           ON changes (scope, scope_id, seq)''',
+    ],
+    # 6: per-user delivery cursor, the change-log position up to which the
+    # user's clients have acknowledged messages
+    [
+        '''CREATE TABLE IF NOT EXISTS delivery_cursors
+           (user_id TEXT PRIMARY KEY, seq INTEGER NOT NULL DEFAULT 0)''',
+    ],
+    # 7: receipts. Messages carry their change-log seq; each participant has
+    # delivered/read watermarks on that seq. Messages older than the change
+    # log keep a NULL seq and count as read.
+    [
+        'ALTER TABLE messages ADD COLUMN seq INTEGER',
+        '''UPDATE messages SET seq = c.seq
+           FROM (SELECT entity_id, MAX(seq) AS seq FROM changes
+                 WHERE kind = 'message' GROUP BY entity_id) AS c
+           WHERE c.entity_id = messages.id''',
+        'ALTER TABLE conversation_participants ADD COLUMN delivered_seq INTEGER NOT NULL DEFAULT 0',
+        'ALTER TABLE conversation_participants ADD COLUMN read_seq INTEGER NOT NULL DEFAULT 0',
+    ],
+    # 8: full-text search over message content. The index keeps its own copy
+    # of the text; message and conversation ids ride along unindexed.
+    [
+        '''CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5
+           (content, conversation_id UNINDEXED, message_id UNINDEXED,
+            tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')''',
+        '''INSERT INTO messages_fts (content, conversation_id, message_id)
+           SELECT content, conversation_id, id FROM messages''',
+    ],
+    # 9: messages move out to the shard files (SHARD_MIGRATIONS). The shard
+    # count they were spread over is recorded, since it can never change.
+    [
+        'CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT)',
+        move_messages_to_shards,
+        'DROP TABLE messages_fts',
+        'DROP TABLE messages',
+    ],
+    # 10: time-ordered integer ids (see IdGenerator). Shard migration 2
+    # renumbers the messages; here the references to them are rewritten and
+    # friend requests and calls are renumbered. Conversations keep their ids
+    # (they pick the shard); new ones get time-ordered ids as text.
+    [
+        upgrade_shards(2),
+        remap_message_references,
+        '''CREATE TABLE friend_requests_v2
+           (id INTEGER PRIMARY KEY, from_user_id TEXT, to_user_id TEXT,
+            status TEXT DEFAULT 'pending', created_at TEXT)''',
+        renumber_table('friend_requests', ('from_user_id', 'to_user_id', 'status', 'created_at'), 'friend_request'),
+        'DROP TABLE friend_requests',
+        'ALTER TABLE friend_requests_v2 RENAME TO friend_requests',
+        '''CREATE INDEX idx_friend_requests_to_status
+           ON friend_requests (to_user_id, status, from_user_id)''',
+        '''CREATE INDEX idx_friend_requests_from_to_status
+           ON friend_requests (from_user_id, to_user_id, status)''',
+        '''CREATE TABLE active_calls_v2
+           (id INTEGER PRIMARY KEY, from_user_id TEXT, to_user_id TEXT,
+            conversation_id TEXT, call_type TEXT, status TEXT,
+            created_at TEXT)''',
+        renumber_table('active_calls', ('from_user_id', 'to_user_id', 'conversation_id', 'call_type', 'status', 'created_at')),
+        'DROP TABLE active_calls',
+        'ALTER TABLE active_calls_v2 RENAME TO active_calls',
+    ],
+    # 11: archived message segments, one per month (see MessageArchive).
+    # Segments cover [first_id, end_id); purged is set once the shard copies
+    # of their messages are deleted.
+    [
+        '''CREATE TABLE IF NOT EXISTS archive_segments
+           (month TEXT PRIMARY KEY, first_id INTEGER, end_id INTEGER,
+            messages INTEGER, archived_at REAL, purged INTEGER NOT NULL DEFAULT 0)''',
+    ],
+]
+
+# Schema of each message shard, versioned the same way
+SHARD_MIGRATIONS = [
+    # 1: messages with the keyset pagination index, and the search index
+    [
+        '''CREATE TABLE IF NOT EXISTS messages
+           (id TEXT PRIMARY KEY, conversation_id TEXT, user_id TEXT,
+            content TEXT, message_type TEXT DEFAULT 'text',
+            timestamp TEXT, status TEXT DEFAULT 'sent', seq INTEGER)''',
+        '''CREATE INDEX IF NOT EXISTS idx_messages_conversation_timestamp_id
+           ON messages (conversation_id, timestamp, id)''',
+        '''CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5
+           (content, conversation_id UNINDEXED, message_id UNINDEXED,
+            tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')''',
+    ],
+    # 2: integer message ids, pages keyed on (conversation_id, id). Existing
+    # messages are numbered in their (timestamp, id) order and the old ids
+    # are kept in legacy_message_ids. The search index is rebuilt with the
+    # message id as its rowid.
+    [
+        '''CREATE TABLE messages_v2
+           (id INTEGER PRIMARY KEY, conversation_id TEXT, user_id TEXT,
+            content TEXT, message_type TEXT DEFAULT 'text',
+            timestamp TEXT, status TEXT DEFAULT 'sent', seq INTEGER)''',
+        '''CREATE TABLE IF NOT EXISTS legacy_message_ids
+           (legacy_id TEXT PRIMARY KEY, id INTEGER NOT NULL)''',
+        renumber_messages,
+        '''INSERT INTO messages_v2 (id, conversation_id, user_id, content, message_type, timestamp, status, seq)
+           SELECT l.id, m.conversation_id, m.user_id, m.content, m.message_type, m.timestamp, m.status, m.seq
+           FROM messages m JOIN legacy_message_ids l ON l.legacy_id = m.id''',
+        'DROP TABLE messages_fts',
+        'DROP TABLE messages',
+        'ALTER TABLE messages_v2 RENAME TO messages',
+        '''CREATE INDEX idx_messages_conversation_id
+           ON messages (conversation_id, id)''',
+        '''CREATE VIRTUAL TABLE messages_fts USING fts5
+           (content, conversation_id UNINDEXED,
+            tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')''',
+        '''INSERT INTO messages_fts (rowid, content, conversation_id)
+           SELECT id, content, conversation_id FROM messages''',
+    ],
+]
+
+def migrate(conn, migrations=MIGRATIONS, name='schema', target=None):
+    # Each migration runs in its own short IMMEDIATE transaction. In WAL mode
+    # readers keep working while it holds the write lock, so a live database
+    # can be upgraded in place. Several workers starting together serialize on
+    # the lock and re-check the version, so each step is applied exactly once.
+    target = len(migrations) if target is None else target
+    while True:
+        current = conn.execute('PRAGMA user_version').fetchone()[0]
+        if current >= target:
+            break
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            current = conn.execute('PRAGMA user_version').fetchone()[0]
+            if current >= target:
+                conn.rollback()
+                break
+            for step in migrations[current]:
+                if callable(step):
+                    step(conn)
+                else:
+                    conn.execute(step)
+            conn.execute(f'PRAGMA user_version = {current + 1}')
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        print(f"Applied {name} migration {current + 1}")
+    # Refresh planner statistics for any new indexes
+    conn.execute('PRAGMA optimize')
 
 # Database setup
 def init_db():
-    conn = sqlite3.connect('whatsapp.db')
-    c = conn.cursor()
-    
-    # Users table
-    c.execute('''CREATE TABLE IF NOT EXISTS users
-                 (id TEXT PRIMARY KEY, username TEXT UNIQUE, display_name TEXT, 
-                  user_code TEXT UNIQUE, online INTEGER DEFAULT 0, last_seen TEXT,
-                  avatar_color TEXT, created_at TEXT)''')
-    
-    # Friend requests
-    c.execute('''CREATE TABLE IF NOT EXISTS friend_requests
-                 (id TEXT PRIMARY KEY, from_user_id TEXT, to_user_id TEXT,
-                  status TEXT DEFAULT 'pending', created_at TEXT)''')
-    
-    # Friends
-    c.execute('''CREATE TABLE IF NOT EXISTS friends
-                 (user_id TEXT, friend_id TEXT, created_at TEXT,
-                  PRIMARY KEY (user_id, friend_id))''')
-    
-    # Conversations
-    c.execute('''CREATE TABLE IF NOT EXISTS conversations
-                 (id TEXT PRIMARY KEY, name TEXT, is_group INTEGER DEFAULT 0,
-                  created_by TEXT, created_at TEXT)''')
-    
-    # Conversation participants
-    c.execute('''CREATE TABLE IF NOT EXISTS conversation_participants
-                 (conversation_id TEXT, user_id TEXT,
-                  PRIMARY KEY (conversation_id, user_id))''')
-    
-    # Messages
-    c.execute('''CREATE TABLE IF NOT EXISTS messages
-                 (id TEXT PRIMARY KEY, conversation_id TEXT, user_id TEXT,
-                  content TEXT, message_type TEXT DEFAULT 'text',
-                  timestamp TEXT, status TEXT DEFAULT 'sent')''')
-    
-    # Active calls
-    c.execute('''CREATE TABLE IF NOT EXISTS active_calls
-                 (id TEXT PRIMARY KEY, from_user_id TEXT, to_user_id TEXT,
-                  conversation_id TEXT, call_type TEXT, status TEXT,
-                  created_at TEXT)''')
-    
-    conn.commit()
-    conn.close()
-
-init_db()
+    # Shards are created first (moving messages out of the main database
+    # needs them); main migrations that rely on a later shard version bring
+    # the shards there themselves (upgrade_shards)
+    for index, pool in enumerate(message_shards.pools):
+        with pool.connection() as conn:
+            migrate(conn, SHARD_MIGRATIONS, f'shard {index}', target=1)
+    with db_pool.connection() as conn:
+        migrate(conn)
+        row = conn.execute("SELECT value FROM settings WHERE key = 'message_shards'").fetchone()
+        if int(row['value']) != message_shards.count:
+            raise RuntimeError(f"The database was created with {row['value']} message shards; "
+                               f"set MESSAGE_SHARDS={row['value']}")
+        # Presence is tracked in memory, so nobody is online after a restart
+        conn.execute('UPDATE users SET online = 0 WHERE online != 0')
+        conn.commit()
+    for index, pool in enumerate(message_shards.pools):
+        with pool.connection() as conn:
+            migrate(conn, SHARD_MIGRATIONS, f'shard {index}')
 
 def get_db():
-    conn = sqlite3.connect('whatsapp.db')
-    conn.row_factory = sqlite3.Row
-    return conn
+    # One pooled connection per request / socket event, released on teardown
+    if 'db' not in g:
+        g.db = db_pool.acquire()
+    return g.db
+
+@app.teardown_appcontext
+def release_db(exc):
+    db = g.pop('db', None)
+    if db is not None:
+        db_pool.release(db)
 
 # Utility functions
+MESSAGE_PREVIEW_LENGTH = 120
+MESSAGE_PAGE_SIZE = 50
+MESSAGE_PAGE_MAX = 200
+SYNC_BATCH_SIZE = 500
+SEARCH_PAGE_SIZE = 20
+SEARCH_PAGE_MAX = 100
+DELIVERY_BATCH_SIZE = 200
+
 def generate_user_code():
     return str(uuid.uuid4())[:8].upper()
 
 def get_user_initial(name):
     return name[0].upper() if name else 'U'
 
+def encode_message_cursor(message):
+    return message['id']
+
+def decode_message_cursor(cursor):
+    # Cursors are message ids, which sort in send order
+    return parse_id(cursor)
+
+def record_change(db, scope, scope_id, kind, entity_id):
+    # Append to the change log read by /api/sync. scope is 'user' or
+    # 'conversation'; kind names the entity that changed. Returns its seq.
+    return db.execute('INSERT INTO changes (scope, scope_id, kind, entity_id) VALUES (?, ?, ?, ?)',
+                      (scope, scope_id, kind, entity_id)).lastrowid
+
+def insert_message(shard, message):
+    # Store the message in its shard. Indexed in the same transaction (under
+    # the message id as rowid), so search never lags behind a send.
+    shard.execute('INSERT INTO messages (id, conversation_id, user_id, content, timestamp) VALUES (?, ?, ?, ?, ?)',
+                  (int(message['id']), message['conversation_id'], message['user_id'], message['content'],
+                   message['timestamp']))
+    shard.execute('INSERT INTO messages_fts (rowid, content, conversation_id) VALUES (?, ?, ?)',
+                  (int(message['id']), message['content'], message['conversation_id']))
+
+def log_message(db, message):
+    # Record a stored message in the main database. The change-log position
+    # doubles as the message's delivery position.
+    message['seq'] = record_change(db, 'conversation', message['conversation_id'], 'message', message['id'])
+    update_last_message(db, message)
+
+def update_last_message(db, message):
+    # Keep the conversation's denormalized last-message columns current.
+    # Messages that arrive out of order never overwrite a newer preview.
+    db.execute('''UPDATE conversations
+                  SET last_message_id = ?, last_message_preview = ?, last_message_at = ?
+                  WHERE id = ? AND (last_message_at IS NULL OR last_message_at <= ?)''',
+               (message['id'], (message['content'] or '')[:MESSAGE_PREVIEW_LENGTH],
+                message['timestamp'], message['conversation_id'], message['timestamp']))
+
+def fts_query(text):
+    # Turn free text into an FTS5 query: every word must match, the last one
+    # as a prefix (search as you type). Quoting keeps FTS5 syntax characters
+    # in user input from being parsed as operators.
+    terms = re.findall(r'\w+', text or '')
+    if not terms:
+        return None
+    quoted = [f'"{term}"' for term in terms]
+    quoted[-1] += '*'
+    return ' '.join(quoted)
+
+# snippet() markers; control characters never occur in typed text
+SNIPPET_START = '\x02'
+SNIPPET_END = '\x03'
+
+def snippet_html(snippet):
+    # Escape the message text and turn the match markers into <mark> tags
+    return html.escape(snippet or '').replace(SNIPPET_START, '<mark>').replace(SNIPPET_END, '</mark>')
+
+def fold(word):
+    # Lower case without diacritics, like the unicode61 tokenizer
+    return ''.join(c for c in unicodedata.normalize('NFKD', word.casefold()) if not unicodedata.combining(c))
+
+def text_snippet(content, text, tokens=16):
+    # snippet() for archived messages, whose search index keeps no text:
+    # the words around the first match, matches marked as fts_query()
+    # matches them (the last term as a prefix)
+    terms = [fold(term) for term in re.findall(r'\w+', text or '')]
+    words = list(re.finditer(r'\w+', content or ''))
+    if not terms or not words:
+        return content or ''
+
+    def matches(word):
+        word = fold(word)
+        return word in terms[:-1] or word.startswith(terms[-1])
+
+    hits = [i for i, word in enumerate(words) if matches(word.group())]
+    start = max(0, min(hits[0] - tokens // 4, len(words) - tokens)) if hits else 0
+    end = min(len(words), start + tokens)
+    parts = ['…' if start else '']
+    position = words[start].start()
+    for word in words[start:end]:
+        parts.append(content[position:word.start()])
+        if matches(word.group()):
+            parts.append(SNIPPET_START + word.group() + SNIPPET_END)
+        else:
+            parts.append(word.group())
+        position = word.end()
+    parts.append(content[position:] if end == len(words) else '…')
+    return ''.join(parts)
+
 def get_avatar_color(user_id):
     colors = ['#FF6B6B', '#4ECDC4', '#45B7D1', '#96CEB4', '#FFEAA7', '#DDA0DD', '#98D8C8', '#F7DC6F']
     return colors[hash(user_id) % len(colors)]
 
+# Message write pipeline
+class MessageWriter:
+    # Group commit: inserts from concurrent senders are collected for up to
+    # max_latency seconds (or max_batch messages) and written in a single
+    # transaction, so many messages share one fsync. submit() only returns
+    # once the batch containing the message has committed, so a message is
+    # never acknowledged or fanned out before it is durable.
+    #
+    # There is one writer per shard. A batch is committed to the shard
+    # first and only then logged in the main database (one short
+    # transaction), so a change-log reader never sees a message it cannot
+    # load; the seq that logging assigns is copied back to the shard last.
+    def __init__(self, pool, main_pool, max_batch=64, max_latency=0.005):
+        self.pool = pool
+        self.main_pool = main_pool
+        self.max_batch = max(1, max_batch)
+        self.max_latency = max(0.0, max_latency)
+        self._queue = None
+        self._empty = None
+        self._start_lock = threading.Lock()
+
+    def _ensure_started(self):
+        if self._queue is not None:
+            return
+        with self._start_lock:
+            if self._queue is None:
+                # Use the Socket.IO server's primitives so waiting yields to
+                # the event loop under eventlet instead of blocking the hub
+                eio = socketio.server.eio
+                self._empty = eio.get_queue_empty_exception()
+                self._queue = eio.create_queue()
+                socketio.start_background_task(self._run)
+
+    def submit(self, message):
+        self._ensure_started()
+        item = {'message': message, 'done': socketio.server.eio.create_event(), 'error': None}
+        self._queue.put(item)
+        item['done'].wait()
+        if item['error'] is not None:
+            raise item['error']
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.max_latency
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                try:
+                    if remaining > 0:
+                        batch.append(self._queue.get(timeout=remaining))
+                    else:
+                        batch.append(self._queue.get(block=False))
+                except self._empty:
+                    break
+            self._write(batch)
+
+    def _write(self, batch):
+        try:
+            with self.pool.connection() as conn:
+                # Open the batch transaction explicitly: a savepoint outside
+                # a transaction starts (and RELEASE commits) one of its own
+                conn.execute('BEGIN IMMEDIATE')
+                for item in batch:
+                    # A savepoint per message keeps one bad row (e.g. a
+                    # duplicate id) from failing the rest of the batch
+                    conn.execute('SAVEPOINT message_write')
+                    try:
+                        insert_message(conn, item['message'])
+                        conn.execute('RELEASE message_write')
+                    except sqlite3.Error as e:
+                        conn.execute('ROLLBACK TO message_write')
+                        conn.execute('RELEASE message_write')
+                        item['error'] = e
+                conn.commit()
+                stored = [item['message'] for item in batch if item['error'] is None]
+                if not stored:
+                    return
+                try:
+                    with self.main_pool.connection() as db:
+                        for message in stored:
+                            log_message(db, message)
+                        db.commit()
+                except Exception:
+                    # Not logged means not sent: take the rows back out
+                    stored_ids = [(int(m['id']),) for m in stored]
+                    conn.executemany('DELETE FROM messages WHERE id = ?', stored_ids)
+                    conn.executemany('DELETE FROM messages_fts WHERE rowid = ?', stored_ids)
+                    conn.commit()
+                    raise
+                conn.executemany('UPDATE messages SET seq = ? WHERE id = ?', [(m['seq'], int(m['id'])) for m in stored])
+                conn.commit()
+        except Exception as e:
+            for item in batch:
+                if item['error'] is None:
+                    item['error'] = e
+        finally:
+            for item in batch:
+                item['done'].set()
+
+    def flush(self):
+        # Write whatever is still queued (used on shutdown)
+        if self._queue is None:
+            return
+        batch = []
+        while True:
+            try:
+                batch.append(self._queue.get(block=False))
+            except self._empty:
+                break
+        if batch:
+            self._write(batch)
+
+message_writers = [MessageWriter(pool, db_pool,
+                                 max_batch=app.config['MESSAGE_BATCH_SIZE'],
+                                 max_latency=app.config['MESSAGE_BATCH_LATENCY_MS'] / 1000.0)
+                   for pool in message_shards.pools]
+
+def store_message(message):
+    message_writers[message_shards.index(message['conversation_id'])].submit(message)
+
+# Presence
+class PresenceRegistry:
+    # Online state lives in memory, keyed by user and socket id, so a user
+    # with several tabs stays online until the last one goes away. Changes
+    # are written to users.online / last_seen in bulk by a background task
+    # instead of one UPDATE per socket event.
+    #
+    # With several workers each one also publishes its own online users
+    # (deltas on every change plus a periodic snapshot); a worker that stops
+    # sending snapshots is forgotten after a few flush intervals.
+    def __init__(self, pool, flush_interval=5.0):
+        self.pool = pool
+        self.flush_interval = flush_interval
+        self._sockets = {}  # user_id -> {sid: online flag}
+        self._remote = {}  # host_id -> {'users': set of online user ids, 'seen': monotonic time}
+        self._dirty = {}  # user_id -> (online, last_seen) waiting to be flushed
+        self._lock = threading.Lock()
+        self._started = False
+
+    def _local_online(self, user_id):
+        return any(self._sockets.get(user_id, {}).values())
+
+    def _online(self, user_id):
+        if self._local_online(user_id):
+            return True
+        return any(user_id in host['users'] for host in self._remote.values())
+
+    def _mark(self, user_id):
+        online = self._online(user_id)
+        self._dirty[user_id] = (1 if online else 0, datetime.now().isoformat())
+        return online
+
+    def _update_local(self, user_id, change):
+        # Apply change() to this worker's sockets; returns (was_online, online)
+        # for the user across all workers and publishes local transitions
+        with self._lock:
+            was_online = self._online(user_id)
+            was_local = self._local_online(user_id)
+            if change() is False:
+                return was_online, was_online
+            now_local = self._local_online(user_id)
+            online = self._mark(user_id)
+        if was_local != now_local:
+            cluster.publish('presence', {'user_id': user_id, 'online': now_local})
+        if online != was_online:
+            # Friends hear about it from the worker where it happened
+            presence_notifier.note(user_id, was_online)
+        return was_online, online
+
+    def connect(self, user_id, sid):
+        # Returns True when this socket brought the user online
+        def change():
+            self._sockets.setdefault(user_id, {})[sid] = True
+        was_online, online = self._update_local(user_id, change)
+        return online and not was_online
+
+    def disconnect(self, user_id, sid):
+        # Returns True when the user's last online socket went away
+        def change():
+            sockets = self._sockets.get(user_id, {})
+            sockets.pop(sid, None)
+            if not sockets:
+                self._sockets.pop(user_id, None)
+        was_online, online = self._update_local(user_id, change)
+        return was_online and not online
+
+    def set_status(self, user_id, sid, online):
+        def change():
+            sockets = self._sockets.get(user_id)
+            if sockets is None or sid not in sockets:
+                return False
+            sockets[sid] = bool(online)
+        self._update_local(user_id, change)
+
+    def remote_update(self, host_id, user_id, online):
+        with self._lock:
+            host = self._remote.setdefault(host_id, {'users': set(), 'seen': time.monotonic()})
+            if online:
+                host['users'].add(user_id)
+            else:
+                host['users'].discard(user_id)
+            self._mark(user_id)
+
+    def remote_snapshot(self, host_id, user_ids):
+        with self._lock:
+            previous = self._remote.get(host_id, {'users': set()})['users']
+            changed = previous ^ set(user_ids)
+            self._remote[host_id] = {'users': set(user_ids), 'seen': time.monotonic()}
+            for user_id in changed:
+                self._mark(user_id)
+
+    def _expire_remote(self):
+        deadline = time.monotonic() - 3 * self.flush_interval
+        changed = []
+        with self._lock:
+            for host_id in [h for h, host in self._remote.items() if host['seen'] < deadline]:
+                users = self._remote[host_id]['users']
+                was_online = {user_id: self._online(user_id) for user_id in users}
+                del self._remote[host_id]
+                for user_id in users:
+                    if self._mark(user_id) != was_online[user_id]:
+                        changed.append((user_id, was_online[user_id]))
+        # Nobody else will announce users of a worker that died. Notify after
+        # releasing the lock: the notifier calls is_online() under its own.
+        for user_id, was_online in changed:
+            presence_notifier.note(user_id, was_online)
+
+    def touch(self, user_id):
+        # Record activity (e.g. a login) without changing socket state
+        with self._lock:
+            self._mark(user_id)
+
+    def is_online(self, user_id):
+        with self._lock:
+            return self._online(user_id)
+
+    def online_among(self, user_ids):
+        with self._lock:
+            return [user_id for user_id in user_ids if self._online(user_id)]
+
+    def sids(self, user_id):
+        # Socket ids the user has connected to this process
+        with self._lock:
+            return list(self._sockets.get(user_id, {}))
+
+    def flush(self):
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+        if not dirty:
+            return
+        with self.pool.connection() as conn:
+            conn.executemany('UPDATE users SET online = ?, last_seen = ? WHERE id = ?',
+                             [(online, last_seen, user_id) for user_id, (online, last_seen) in dirty.items()])
+            conn.commit()
+
+    def start(self):
+        if not self._started:
+            self._started = True
+            socketio.start_background_task(self._run)
+
+    def _run(self):
+        while True:
+            socketio.sleep(self.flush_interval)
+            if cluster.enabled:
+                with self._lock:
+                    local_users = [user_id for user_id in self._sockets if self._local_online(user_id)]
+                cluster.publish('presence_snapshot', {'users': local_users})
+                self._expire_remote()
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                print(f"Presence flush failed: {e}")
+
+presence = PresenceRegistry(db_pool, flush_interval=app.config['PRESENCE_FLUSH_INTERVAL'])
+
+class PresenceNotifier:
+    # Pushes online/offline changes to the user's online friends. A change is
+    # only sent once it has held for `delay` seconds (a reconnect within that
+    # window cancels it) and at most once per `min_interval` per user. Each
+    # tick sends one 'presence' event per recipient with every friend that
+    # changed, so a busy contact list still costs one emit per friend.
+    def __init__(self, pool, delay=2.0, min_interval=5.0):
+        self.pool = pool
+        self.delay = delay
+        self.min_interval = min_interval
+        self._pending = {}  # user_id -> [online before the first change, time of the latest change]
+        self._last_sent = {}  # user_id -> monotonic time of the last broadcast
+        self._lock = threading.Lock()
+        self._started = False
+
+    def note(self, user_id, was_online):
+        with self._lock:
+            entry = self._pending.setdefault(user_id, [was_online, 0])
+            entry[1] = time.monotonic()
+        self.start()
+
+    def _due(self):
+        now = time.monotonic()
+        due = []
+        with self._lock:
+            for user_id, (was_online, changed_at) in list(self._pending.items()):
+                if now - changed_at < self.delay or now - self._last_sent.get(user_id, -self.min_interval) < self.min_interval:
+                    continue
+                del self._pending[user_id]
+                online = presence.is_online(user_id)
+                if online != was_online:
+                    self._last_sent[user_id] = now
+                    due.append((user_id, online))
+            for user_id in [u for u, sent in self._last_sent.items() if now - sent >= self.min_interval]:
+                del self._last_sent[user_id]
+        return due
+
+    def flush(self):
+        due = self._due()
+        if not due:
+            return
+        changes = {user_id: online for user_id, online in due}
+        with self.pool.connection() as conn:
+            rows = conn.execute('''
+                SELECT user_id, friend_id FROM friends
+                WHERE user_id IN (SELECT value FROM json_each(?))
+            ''', (json.dumps(list(changes)),)).fetchall()
+        last_seen = datetime.now().isoformat()
+        updates = {}  # recipient -> list of friend changes
+        for row in rows:
+            if presence.is_online(row['friend_id']):
+                updates.setdefault(row['friend_id'], []).append(
+                    {'user_id': row['user_id'], 'online': changes[row['user_id']], 'last_seen': last_seen})
+        for recipient, users in updates.items():
+            socketio.emit('presence', {'users': users}, room=recipient)
+
+    def start(self):
+        if not self._started:
+            self._started = True
+            socketio.start_background_task(self._run)
+
+    def _run(self):
+        while True:
+            socketio.sleep(min(self.delay, self.min_interval) / 2 or 0.5)
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                print(f"Presence broadcast failed: {e}")
+
+presence_notifier = PresenceNotifier(db_pool, delay=app.config['PRESENCE_BROADCAST_DELAY'],
+                                     min_interval=app.config['PRESENCE_BROADCAST_MIN_INTERVAL'])
+
+# Message cache
+class MessageCache:
+    # Ring buffer of the newest messages per conversation (with display
+    # names resolved), so the first page of a busy chat is served without
+    # touching SQLite. Buffers are filled on first read and appended to on
+    # every write; conversations are evicted least recently used once either
+    # the conversation count or the approximate memory cap is exceeded.
+    def __init__(self, size=100, max_conversations=1000, max_bytes=32 * 1024 * 1024):
+        self.size = size
+        self.max_conversations = max_conversations
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # conversation_id -> entry
+        self._filling = {}  # conversation_id -> True once a write raced the fill
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(message):
+        return int(message['id'])
+
+    @staticmethod
+    def _cost(message):
+        return 200 + sum(len(str(value)) for value in message.values())
+
+    def get(self, conversation_id, limit):
+        # Returns (messages, has_more) for the newest page, or None on a miss
+        with self._lock:
+            entry = self._entries.get(conversation_id)
+            if entry is None or limit > self.size:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(conversation_id)
+            self.hits += 1
+            messages = entry['messages']
+            return messages[-limit:], len(messages) > limit or entry['has_older']
+
+    def begin_fill(self, conversation_id):
+        with self._lock:
+            self._filling[conversation_id] = False
+
+    def fill(self, conversation_id, newest_first, has_older):
+        # newest_first holds up to `size` rows read after begin_fill(). If a
+        # write landed in between, the rows may be stale, so skip caching.
+        with self._lock:
+            raced = self._filling.pop(conversation_id, True)
+            if raced or conversation_id in self._entries:
+                return
+            messages = [dict(row) for row in reversed(newest_first)]
+            entry = {'messages': messages, 'has_older': has_older,
+                     'keys': [self._key(m) for m in messages],
+                     'bytes': sum(self._cost(m) for m in messages)}
+            self._entries[conversation_id] = entry
+            self.bytes += entry['bytes']
+            self._evict()
+
+    def append(self, message, display_name):
+        with self._lock:
+            conversation_id = message['conversation_id']
+            if conversation_id in self._filling:
+                self._filling[conversation_id] = True
+            entry = self._entries.get(conversation_id)
+            if entry is None:
+                return
+            message = dict(message, message_type='text', status='sent', display_name=display_name)
+            key = self._key(message)
+            position = bisect.bisect_left(entry['keys'], key)
+            if position < len(entry['keys']) and entry['keys'][position] == key:
+                # Already cached by a fill that read the row before its seq
+                # was set: keep one copy, the one carrying the seq
+                cost = self._cost(message) - self._cost(entry['messages'][position])
+                entry['messages'][position] = message
+                entry['bytes'] += cost
+                self.bytes += cost
+                return
+            if position == 0 and len(entry['messages']) >= self.size:
+                # Older than everything in a full buffer: not among the newest
+                return
+            entry['keys'].insert(position, key)
+            entry['messages'].insert(position, message)
+            entry['bytes'] += self._cost(message)
+            self.bytes += self._cost(message)
+            while len(entry['messages']) > self.size:
+                entry['keys'].pop(0)
+                dropped = entry['messages'].pop(0)
+                entry['bytes'] -= self._cost(dropped)
+                self.bytes -= self._cost(dropped)
+                entry['has_older'] = True
+            self._entries.move_to_end(conversation_id)
+            self._evict()
+
+    def _evict(self):
+        while self._entries and (len(self._entries) > self.max_conversations or self.bytes > self.max_bytes):
+            _, entry = self._entries.popitem(last=False)
+            self.bytes -= entry['bytes']
+
+    def stats(self):
+        with self._lock:
+            return {'conversations': len(self._entries), 'bytes': self.bytes,
+                    'hits': self.hits, 'misses': self.misses}
+
+message_cache = MessageCache(size=app.config['MESSAGE_CACHE_SIZE'],
+                             max_conversations=app.config['MESSAGE_CACHE_CONVERSATIONS'],
+                             max_bytes=app.config['MESSAGE_CACHE_MAX_BYTES'])
+
+# Read-through caches
+class TTLCache:
+    # LRU cache whose entries also expire after `ttl` seconds. Misses call
+    # the loader; a None result is not cached so new rows show up at once.
+    def __init__(self, max_entries=10000, ttl=60.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+
+    def get(self, key, loader):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        value = loader()
+        if value is not None:
+            with self._lock:
+                self._entries[key] = (now + self.ttl, value)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return value
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+user_cache = TTLCache(max_entries=app.config['USER_CACHE_SIZE'], ttl=app.config['USER_CACHE_TTL'])
+participant_cache = TTLCache(max_entries=app.config['PARTICIPANT_CACHE_SIZE'],
+                             ttl=app.config['PARTICIPANT_CACHE_TTL'])
+
+def get_user(db, user_id):
+    return user_cache.get(user_id, lambda: db.execute('SELECT * FROM users WHERE id = ?', (user_id,)).fetchone())
+
+def get_participants(db, conversation_id):
+    # User ids in the conversation, as a tuple
+    def load():
+        rows = db.execute('SELECT user_id FROM conversation_participants WHERE conversation_id = ?',
+                          (conversation_id,)).fetchall()
+        return tuple(row['user_id'] for row in rows) or None
+    return participant_cache.get(conversation_id, load) or ()
+
+# Cold storage
+ARCHIVE_BLOCK_SIZE = 64
+ARCHIVE_FIELDS = ('id', 'user_id', 'content', 'message_type', 'timestamp', 'status', 'seq')
+# How often workers reread the segment list, and how long a new segment is
+# left alongside the shard copies so every worker has switched to it
+ARCHIVE_REFRESH_INTERVAL = 30.0
+ARCHIVE_PURGE_DELAY = 3 * ARCHIVE_REFRESH_INTERVAL
+
+ARCHIVE_SEGMENT_SCHEMA = [
+    # Messages in zlib-compressed JSON blocks of up to ARCHIVE_BLOCK_SIZE
+    # per conversation
+    '''CREATE TABLE blocks
+       (id INTEGER PRIMARY KEY, conversation_id TEXT, first_id INTEGER,
+        last_id INTEGER, data BLOB)''',
+    'CREATE INDEX idx_blocks_conversation ON blocks (conversation_id, first_id)',
+    # Message id -> block, for lookups by id and to scope search hits
+    'CREATE TABLE message_index (id INTEGER PRIMARY KEY, conversation_id TEXT, block_id INTEGER)',
+    # Contentless (the text is only in the blocks), rowid is the message id
+    '''CREATE VIRTUAL TABLE messages_fts USING fts5
+       (content, content = '', tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')''',
+]
+
+class MessageArchive:
+    # Read side of the archive tier. Each segment is a sealed SQLite file
+    # holding one UTC month of messages, which with time-ordered ids is one
+    # id range. Every message below boundary() is read from the segments;
+    # shard copies that are still waiting to be purged are ignored. Blocks
+    # are decompressed on first use and kept in an LRU cache.
+    def __init__(self, path, cache_blocks=2000, refresh_interval=30.0):
+        root, ext = os.path.splitext(path)
+        self.prefix = f'{root}-archive-'
+        self.ext = ext or '.db'
+        self.refresh_interval = refresh_interval
+        # Segments never change, so cached blocks never expire
+        self.blocks = TTLCache(max_entries=cache_blocks, ttl=float('inf'))
+        self._segments = []  # newest first
+        self._loaded_at = None
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def path_for(self, month):
+        return f'{self.prefix}{month}{self.ext}'
+
+    def segments(self, db):
+        # Reread every refresh_interval, or sooner after reload()
+        if self._loaded_at is None or time.monotonic() - self._loaded_at > self.refresh_interval:
+            rows = db.execute('SELECT month, first_id, end_id FROM archive_segments ORDER BY first_id DESC').fetchall()
+            self._segments = [dict(row) for row in rows]
+            self._loaded_at = time.monotonic()
+        return self._segments
+
+    def reload(self):
+        self._loaded_at = None
+
+    def boundary(self, db):
+        # Ids below this are archived
+        segments = self.segments(db)
+        return segments[0]['end_id'] if segments else 0
+
+    def _pool(self, month):
+        with self._lock:
+            pool = self._pools.get(month)
+            if pool is None:
+                pool = self._pools[month] = ConnectionPool(self.path_for(month), size=2, readonly=True)
+            return pool
+
+    def _block(self, month, block_id):
+        # Decoded messages of a block, oldest first. Shared with the cache,
+        # so callers copy a message before changing it.
+        def load():
+            with self._pool(month).connection() as segment:
+                row = segment.execute('SELECT conversation_id, data FROM blocks WHERE id = ?', (block_id,)).fetchone()
+            return [dict(zip(ARCHIVE_FIELDS, values), conversation_id=row['conversation_id'])
+                    for values in json.loads(zlib.decompress(row['data']))]
+        return self.blocks.get((month, block_id), load)
+
+    def page(self, db, conversation_id, before=None, after=None, limit=MESSAGE_PAGE_SIZE):
+        # Up to `limit` archived messages of a conversation: oldest first
+        # above `after`, otherwise newest first (below `before` if given)
+        segments = self.segments(db)
+        if after is not None:
+            segments = [segment for segment in reversed(segments) if segment['end_id'] > after]
+        elif before is not None:
+            segments = [segment for segment in segments if segment['first_id'] < before]
+        result = []
+        for segment in segments:
+            with self._pool(segment['month']).connection() as conn:
+                if after is not None:
+                    blocks = conn.execute('''SELECT id FROM blocks WHERE conversation_id = ? AND last_id > ?
+                                             ORDER BY first_id''', (conversation_id, after)).fetchall()
+                else:
+                    blocks = conn.execute('''SELECT id FROM blocks WHERE conversation_id = ? AND first_id < ?
+                                             ORDER BY first_id DESC''',
+                                          (conversation_id, segment['end_id'] if before is None else before)).fetchall()
+            for block in blocks:
+                messages = self._block(segment['month'], block['id'])
+                if after is not None:
+                    result.extend(m for m in messages if m['id'] > after)
+                else:
+                    result.extend(m for m in reversed(messages) if before is None or m['id'] < before)
+                if len(result) >= limit:
+                    return result[:limit]
+        return result
+
+    def get(self, db, message_ids):
+        # Archived messages by id, in no particular order
+        result = []
+        for segment in self.segments(db):
+            wanted = [i for i in message_ids if segment['first_id'] <= i < segment['end_id']]
+            if not wanted:
+                continue
+            with self._pool(segment['month']).connection() as conn:
+                rows = conn.execute('SELECT id, block_id FROM message_index WHERE id IN (SELECT value FROM json_each(?))',
+                                    (json.dumps(wanted),)).fetchall()
+            for row in rows:
+                result.extend(m for m in self._block(segment['month'], row['block_id']) if m['id'] == row['id'])
+        return result
+
+    def search(self, db, match, text, conversation_ids, limit):
+        # The best `limit` hits of every segment, in the shape of api_search
+        rows = []
+        for segment in self.segments(db):
+            with self._pool(segment['month']).connection() as conn:
+                hits = conn.execute('''
+                    SELECT f.rowid AS id, i.block_id, f.rank
+                    FROM messages_fts f
+                    JOIN message_index i ON i.id = f.rowid
+                    WHERE messages_fts MATCH ?
+                      AND i.conversation_id IN (SELECT value FROM json_each(?))
+                    ORDER BY f.rank
+                    LIMIT ?
+                ''', (match, json.dumps(conversation_ids), limit)).fetchall()
+            for hit in hits:
+                for message in self._block(segment['month'], hit['block_id']):
+                    if message['id'] == hit['id']:
+                        rows.append({'id': message['id'], 'conversation_id': message['conversation_id'],
+                                     'user_id': message['user_id'], 'timestamp': message['timestamp'],
+                                     'seq': message['seq'], 'rank': hit['rank'],
+                                     'snippet': text_snippet(message['content'], text)})
+        return rows
+
+    def close_all(self):
+        with self._lock:
+            pools, self._pools = list(self._pools.values()), {}
+        for pool in pools:
+            pool.close_all()
+
+message_archive = MessageArchive(app.config['DATABASE'],
+                                 cache_blocks=app.config['ARCHIVE_CACHE_BLOCKS'],
+                                 refresh_interval=ARCHIVE_REFRESH_INTERVAL)
+
+def month_of(message_id):
+    # (name, first id, end id) of the UTC month an id was generated in
+    start = datetime.fromtimestamp(id_ms(message_id) / 1000, timezone.utc).replace(
+        day=1, hour=0, minute=0, second=0, microsecond=0)
+    end = start.replace(year=start.year + 1, month=1) if start.month == 12 else start.replace(month=start.month + 1)
+    return (start.strftime('%Y-%m'), id_at_ms(int(start.timestamp() * 1000)),
+            id_at_ms(int(end.timestamp() * 1000)))
+
+class MessageArchiver:
+    # Write side of the archive tier. A month is archived once all of it is
+    # older than after_days: its messages are written to a new segment file
+    # (built under a temporary name and renamed into place), the segment is
+    # registered in the main database, and a later run deletes the shard
+    # copies once every worker reads the month from the segment. Each step
+    # can be repeated, so an interrupted run is simply redone by the next.
+    def __init__(self, pool, shards, archive, after_days=180.0, interval=3600.0):
+        self.pool = pool
+        self.shards = shards
+        self.archive = archive
+        self.after_days = after_days
+        self.interval = interval
+        self._started = False
+
+    def start(self):
+        if not self._started and self.after_days > 0 and self.interval > 0:
+            self._started = True
+            socketio.start_background_task(self._run)
+
+    def _run(self):
+        while True:
+            socketio.sleep(self.interval)
+            try:
+                self.run()
+            except (sqlite3.Error, OSError) as e:
+                print(f"Archiving failed: {e}")
+
+    def _claim(self):
+        # Only one worker per interval does the work
+        now = time.time()
+        with self.pool.connection() as db:
+            row = db.execute('''INSERT INTO settings (key, value) VALUES ('archiver_lease', ?)
+                                ON CONFLICT (key) DO UPDATE SET value = excluded.value
+                                WHERE CAST(settings.value AS REAL) < ?
+                                RETURNING value''', (now + self.interval / 2, now)).fetchone()
+            db.commit()
+        return row is not None
+
+    def run(self):
+        if not self._claim():
+            return
+        self.purge()
+        cutoff_ms = int((time.time() - self.after_days * 86400) * 1000)
+        with self.pool.connection() as db:
+            start = db.execute('SELECT COALESCE(MAX(end_id), 0) FROM archive_segments').fetchone()[0]
+        while True:
+            oldest = self._oldest(start)
+            if oldest is None:
+                break
+            month, first_id, end_id = month_of(oldest)
+            if id_ms(end_id) > cutoff_ms:
+                break
+            count = db_executor.run(self._write_segment, month, first_id, end_id)
+            with self.pool.connection() as db:
+                db.execute('''INSERT OR IGNORE INTO archive_segments (month, first_id, end_id, messages, archived_at)
+                              VALUES (?, ?, ?, ?, ?)''', (month, first_id, end_id, count, time.time()))
+                db.commit()
+            self.archive.reload()
+            cluster.publish('archive_changed', {})
+            print(f"Archived {count} messages from {month}")
+            start = end_id
+
+    def _oldest(self, since_id):
+        # Oldest message id in the shards at or above since_id
+        oldest = None
+        for pool in self.shards.pools:
+            with pool.connection() as shard:
+                value = shard.execute('SELECT MIN(id) FROM messages WHERE id >= ?', (since_id,)).fetchone()[0]
+            if value is not None and (oldest is None or value < oldest):
+                oldest = value
+        return oldest
+
+    def _write_segment(self, month, first_id, end_id):
+        # Runs on a database thread with plain sqlite3 connections. Reads the
+        # month from every shard in id order, cutting a block whenever a
+        # conversation has ARCHIVE_BLOCK_SIZE messages pending.
+        path = self.archive.path_for(month)
+        if os.path.exists(path):
+            # Written by an earlier, interrupted run
+            conn = sqlite3.connect(Path(path).absolute().as_uri() + '?mode=ro', uri=True)
+            try:
+                return conn.execute('SELECT COUNT(*) FROM message_index').fetchone()[0]
+            finally:
+                conn.close()
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        out = sqlite3.connect(temp_path)
+        try:
+            for step in ARCHIVE_SEGMENT_SCHEMA:
+                out.execute(step)
+            count = 0
+            for shard_path in self.shards.paths:
+                shard = sqlite3.connect(shard_path)
+                try:
+                    pending = {}
+                    last_id = first_id - 1
+                    while True:
+                        rows = shard.execute('''SELECT id, conversation_id, user_id, content, message_type,
+                                                       timestamp, status, seq
+                                                FROM messages WHERE id > ? AND id < ? ORDER BY id LIMIT 5000''',
+                                             (last_id, end_id)).fetchall()
+                        if not rows:
+                            break
+                        last_id = rows[-1][0]
+                        count += len(rows)
+                        for row in rows:
+                            block = pending.setdefault(row[1], [])
+                            block.append(row)
+                            if len(block) >= ARCHIVE_BLOCK_SIZE:
+                                self._write_block(out, row[1], pending.pop(row[1]))
+                    for conversation_id, block in pending.items():
+                        self._write_block(out, conversation_id, block)
+                finally:
+                    shard.close()
+            out.commit()
+            out.close()
+            os.replace(temp_path, path)
+        except BaseException:
+            out.close()
+            os.remove(temp_path)
+            raise
+        return count
+
+    @staticmethod
+    def _write_block(out, conversation_id, rows):
+        data = zlib.compress(json.dumps([[row[0]] + list(row[2:]) for row in rows]).encode('utf-8'))
+        block_id = out.execute('INSERT INTO blocks (conversation_id, first_id, last_id, data) VALUES (?, ?, ?, ?)',
+                               (conversation_id, rows[0][0], rows[-1][0], data)).lastrowid
+        out.executemany('INSERT INTO message_index (id, conversation_id, block_id) VALUES (?, ?, ?)',
+                        [(row[0], conversation_id, block_id) for row in rows])
+        out.executemany('INSERT INTO messages_fts (rowid, content) VALUES (?, ?)',
+                        [(row[0], row[3] or '') for row in rows])
+
+    def purge(self):
+        # Delete the shard copies of segments every worker has picked up, in
+        # small transactions so senders on the shard are not held up
+        with self.pool.connection() as db:
+            segments = db.execute('SELECT month, first_id, end_id FROM archive_segments WHERE purged = 0 AND archived_at < ?',
+                                  (time.time() - ARCHIVE_PURGE_DELAY,)).fetchall()
+        for segment in segments:
+            for pool in self.shards.pools:
+                with pool.connection() as shard:
+                    while True:
+                        rows = shard.execute('SELECT id FROM messages WHERE id >= ? AND id < ? LIMIT 1000',
+                                             (segment['first_id'], segment['end_id'])).fetchall()
+                        if not rows:
+                            break
+                        shard.executemany('DELETE FROM messages WHERE id = ?', [(row['id'],) for row in rows])
+                        shard.executemany('DELETE FROM messages_fts WHERE rowid = ?', [(row['id'],) for row in rows])
+                        shard.commit()
+            with self.pool.connection() as db:
+                db.execute('UPDATE archive_segments SET purged = 1 WHERE month = ?', (segment['month'],))
+                db.commit()
+
+archiver = MessageArchiver(db_pool, message_shards, message_archive,
+                           after_days=app.config['ARCHIVE_AFTER_DAYS'],
+                           interval=app.config['ARCHIVE_INTERVAL'])
+
+# Conversation rooms
+# Every socket joins one room per conversation its user belongs to, so a
+# message is fanned out with a single emit instead of one per participant.
+def conversation_room(conversation_id):
+    return f"conversation:{conversation_id}"
+
+def join_conversation_rooms(db, user_id, sid):
+    rows = db.execute('SELECT conversation_id FROM conversation_participants WHERE user_id = ?',
+                      (user_id,)).fetchall()
+    for row in rows:
+        socketio.server.enter_room(sid, conversation_room(row['conversation_id']), namespace='/')
+
+def enter_user_room(user_id, room):
+    for sid in presence.sids(user_id):
+        socketio.server.enter_room(sid, room, namespace='/')
+
+def add_to_conversation_room(conversation_id, user_id):
+    # Keep room membership in sync when a user joins a conversation; the
+    # user's sockets on other workers are joined through the cluster
+    enter_user_room(user_id, conversation_room(conversation_id))
+    cluster.publish('enter_room', {'user_id': user_id, 'room': conversation_room(conversation_id)})
+
+def invalidate_user(user_id):
+    user_cache.invalidate(user_id)
+    cluster.publish('invalidate_user', {'user_id': user_id})
+
+def invalidate_participants(conversation_id):
+    participant_cache.invalidate(conversation_id)
+    cluster.publish('invalidate_participants', {'conversation_id': conversation_id})
+
+# Cross-worker message handlers
+@cluster.on('enter_room')
+def on_enter_room(host_id, payload):
+    enter_user_room(payload['user_id'], payload['room'])
+
+@cluster.on('message_stored')
+def on_message_stored(host_id, payload):
+    message_cache.append(payload['message'], payload['display_name'])
+
+@cluster.on('invalidate_user')
+def on_invalidate_user(host_id, payload):
+    user_cache.invalidate(payload['user_id'])
+
+@cluster.on('invalidate_participants')
+def on_invalidate_participants(host_id, payload):
+    participant_cache.invalidate(payload['conversation_id'])
+
+@cluster.on('presence')
+def on_presence(host_id, payload):
+    presence.remote_update(host_id, payload['user_id'], payload['online'])
+
+@cluster.on('presence_snapshot')
+def on_presence_snapshot(host_id, payload):
+    presence.remote_snapshot(host_id, payload['users'])
+
+@cluster.on('archive_changed')
+def on_archive_changed(host_id, payload):
+    message_archive.reload()
+
+# Message delivery
+def deliver_message(data):
+    # Shared by the REST endpoint and the socket handler: store the message
+    # (blocking until its group commit is durable), then fan it out
+    # The id and timestamp are assigned here; whatever the client sent is
+    # only its placeholder until the ack
+    message_id = id_generator.next()
+    message = {
+        'id': str(message_id),
+        'conversation_id': data['conversation_id'],
+        'user_id': data['user_id'],
+        'content': data['content'],
+        'timestamp': id_timestamp(message_id)
+    }
+    store_message(message)
+    sender = get_user(get_db(), message['user_id'])
+    if sender is not None:
+        message_cache.append(message, sender['display_name'])
+        cluster.publish('message_stored', {'message': message, 'display_name': sender['display_name']})
+    
+    # One emit to the conversation room; the sender's own sockets are skipped
+    socketio.emit('new_message', {
+        'conversation_id': message['conversation_id'],
+        'message': message
+    }, room=conversation_room(message['conversation_id']), skip_sid=presence.sids(message['user_id']))
+    return message
+
+# Offline delivery
+class DeliveryReplayer:
+    # Messages emitted while a user had no socket are not lost: each user has
+    # a delivery cursor (a change-log seq) that clients advance by acking what
+    # they received. On connect everything after the cursor is streamed to
+    # the new socket in batches, the next batch only after the client acked
+    # the previous one, so a long absence never floods a slow connection.
+    def __init__(self, pool, batch_size=200):
+        self.pool = pool
+        self.batch_size = batch_size
+        self._replaying = set()  # sids that have not caught up yet
+
+    def cursor(self, db, user_id):
+        row = db.execute('SELECT seq FROM delivery_cursors WHERE user_id = ?', (user_id,)).fetchone()
+        if row is not None:
+            return row['seq']
+        # First connection: the client loads its initial state from /api/sync
+        seq = db.execute('SELECT COALESCE(MAX(seq), 0) FROM changes').fetchone()[0]
+        db.execute('INSERT OR IGNORE INTO delivery_cursors (user_id, seq) VALUES (?, ?)', (user_id, seq))
+        db.commit()
+        return seq
+
+    def advance(self, db, user_id, seq):
+        # Cursors only move forward, whatever order acks arrive in
+        db.execute('''INSERT INTO delivery_cursors (user_id, seq) VALUES (?, ?)
+                      ON CONFLICT (user_id) DO UPDATE SET seq = MAX(seq, excluded.seq)''',
+                   (user_id, seq))
+        db.commit()
+
+    def is_replaying(self, sid):
+        return sid in self._replaying
+
+    def start(self, user_id, sid):
+        self._replaying.add(sid)
+        socketio.start_background_task(self._send_batch, user_id, sid, None)
+
+    def stop(self, sid):
+        self._replaying.discard(sid)
+
+    def _send_batch(self, user_id, sid, since):
+        if sid not in self._replaying:
+            return
+        try:
+            with self.pool.connection() as db:
+                if since is None:
+                    since = self.cursor(db, user_id)
+                messages = query_missed_messages(db, user_id, since, self.batch_size + 1)
+        except sqlite3.Error as e:
+            print(f"Delivery replay for {user_id} failed: {e}")
+            self.stop(sid)
+            return
+        has_more = len(messages) > self.batch_size
+        messages = messages[:self.batch_size]
+        if not messages:
+            self.stop(sid)
+            return
+        cursor = messages[-1]['seq']
+        latest = {message['conversation_id']: message['seq'] for message in messages}
+
+        def acked(*args):
+            with self.pool.connection() as db:
+                self.advance(db, user_id, cursor)
+            for conversation_id, seq in latest.items():
+                receipts.delivered(conversation_id, user_id, seq)
+            if has_more:
+                self._send_batch(user_id, sid, cursor)
+            else:
+                self.stop(sid)
+
+        socketio.emit('missed_messages', {'messages': messages, 'cursor': cursor, 'has_more': has_more},
+                      to=sid, callback=acked)
+
+delivery = DeliveryReplayer(db_pool, batch_size=DELIVERY_BATCH_SIZE)
+
+# Receipts
+class ReceiptTracker:
+    # Delivered/read state is a pair of watermarks per participant
+    # (conversation_participants.delivered_seq / read_seq): everything in the
+    # conversation up to that seq has reached / been read by them. A message's
+    # status follows from its seq and the other participants' watermarks, so
+    # nothing is written per message. Updates are merged in memory and
+    # written in one transaction every flush_interval, followed by one
+    # 'receipts' emit per conversation: reading a burst of messages in a big
+    # chat costs one write and one emit.
+    def __init__(self, pool, flush_interval=1.0):
+        self.pool = pool
+        self.flush_interval = flush_interval
+        self._pending = {}  # (conversation_id, user_id) -> [delivered_seq, read_seq]
+        self._lock = threading.Lock()
+        self._started = False
+
+    def _note(self, conversation_id, user_id, delivered_seq, read_seq):
+        with self._lock:
+            entry = self._pending.setdefault((conversation_id, user_id), [0, 0])
+            # Reading a message implies it was delivered
+            entry[0] = max(entry[0], delivered_seq, read_seq)
+            entry[1] = max(entry[1], read_seq)
+        self.start()
+
+    def delivered(self, conversation_id, user_id, seq):
+        self._note(conversation_id, user_id, seq, 0)
+
+    def read(self, conversation_id, user_id, seq):
+        self._note(conversation_id, user_id, seq, seq)
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        by_conversation = {}
+        for (conversation_id, user_id), (delivered_seq, read_seq) in pending.items():
+            by_conversation.setdefault(conversation_id, []).append(
+                {'user_id': user_id, 'delivered_seq': delivered_seq, 'read_seq': read_seq})
+        with self.pool.connection() as conn:
+            conn.executemany('''UPDATE conversation_participants
+                                SET delivered_seq = MAX(delivered_seq, ?), read_seq = MAX(read_seq, ?)
+                                WHERE conversation_id = ? AND user_id = ?''',
+                             [(delivered_seq, read_seq, conversation_id, user_id)
+                              for (conversation_id, user_id), (delivered_seq, read_seq) in pending.items()])
+            # Message pages include receipts, so their ETags must change
+            for conversation_id in by_conversation:
+                record_change(conn, 'conversation', conversation_id, 'receipt', conversation_id)
+            conn.commit()
+        # Watermarks only grow, so clients merge these with max()
+        for conversation_id, updates in by_conversation.items():
+            socketio.emit('receipts', {'conversation_id': conversation_id, 'receipts': updates},
+                          room=conversation_room(conversation_id))
+
+    def start(self):
+        if not self._started:
+            self._started = True
+            socketio.start_background_task(self._run)
+
+    def _run(self):
+        while True:
+            socketio.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except sqlite3.Error as e:
+                print(f"Receipt flush failed: {e}")
+
+receipts = ReceiptTracker(db_pool, flush_interval=app.config['RECEIPT_FLUSH_INTERVAL'])
+
+# Typing indicators
+class TypingRelay:
+    # Forwards typing state to the conversation room. Per user and
+    # conversation a change of state goes out at most once per min_interval
+    # (a change that arrives sooner is held and sent when the interval is up,
+    # so the last state always wins) and a continuing "typing" is only
+    # repeated every refresh_interval. Clients drop an indicator that has not
+    # been refreshed, so a lost "stopped" event cannot stick.
+    def __init__(self, min_interval=1.0, refresh_interval=3.0):
+        self.min_interval = min_interval
+        self.refresh_interval = refresh_interval
+        self._state = {}  # (user_id, conversation_id) -> {'sent', 'sent_at', 'pending'}
+        self._lock = threading.Lock()
+        self._started = False
+
+    def note(self, user_id, conversation_id, typing):
+        self.start()
+        now = time.monotonic()
+        with self._lock:
+            state = self._state.setdefault((user_id, conversation_id),
+                                           {'sent': False, 'sent_at': -self.refresh_interval, 'pending': None})
+            if typing == state['sent'] and (not typing or now - state['sent_at'] < self.refresh_interval):
+                state['pending'] = None
+                return
+            if now - state['sent_at'] < self.min_interval:
+                state['pending'] = typing
+                return
+            state.update(sent=typing, sent_at=now, pending=None)
+        self._emit(user_id, conversation_id, typing)
+
+    def _emit(self, user_id, conversation_id, typing):
+        socketio.emit('typing', {'conversation_id': conversation_id, 'user_id': user_id, 'typing': typing},
+                      room=conversation_room(conversation_id), skip_sid=presence.sids(user_id))
+
+    def start(self):
+        if not self._started:
+            self._started = True
+            socketio.start_background_task(self._run)
+
+    def _run(self):
+        while True:
+            socketio.sleep(self.min_interval / 2 or 0.5)
+            now = time.monotonic()
+            due = []
+            with self._lock:
+                for key, state in list(self._state.items()):
+                    if state['pending'] is not None and now - state['sent_at'] >= self.min_interval:
+                        due.append((key, state['pending']))
+                        state.update(sent=state['pending'], sent_at=now, pending=None)
+                    elif state['pending'] is None and now - state['sent_at'] >= (
+                            2 * self.refresh_interval if state['sent'] else self.min_interval):
+                        # Stopped, or a client that went away mid-typing
+                        del self._state[key]
+            for (user_id, conversation_id), typing in due:
+                self._emit(user_id, conversation_id, typing)
+
+typing_relay = TypingRelay(min_interval=app.config['TYPING_MIN_INTERVAL'],
+                           refresh_interval=app.config['TYPING_REFRESH_INTERVAL'])
+
+# Shared queries
+# Each takes an optional list of ids to restrict the result to, which lets
+# /api/sync reuse the same shapes as the full-list endpoints.
+def query_conversations(db, user_id, ids=None):
+    # One query for the whole list: the last message comes from the
+    # denormalized columns and one-to-one chats are named after the peer
+    query = '''
+        SELECT c.id, c.is_group, c.created_by, c.created_at,
+               c.last_message_id, c.last_message_preview, c.last_message_at,
+               c.last_message_preview AS last_message,
+               CASE WHEN c.is_group = 0 AND peer.id IS NOT NULL
+                    THEN peer.display_name ELSE c.name END AS name,
+               CASE WHEN c.is_group = 0 THEN peer.avatar_color END AS avatar_color,
+               CASE WHEN c.is_group = 0 THEN peer.id END AS peer_id
+        FROM conversation_participants cp
+        JOIN conversations c ON c.id = cp.conversation_id
+        LEFT JOIN conversation_participants pp
+               ON c.is_group = 0 AND pp.conversation_id = c.id AND pp.user_id != cp.user_id
+        LEFT JOIN users peer ON peer.id = pp.user_id
+        WHERE cp.user_id = ?
+    '''
+    params = [user_id]
+    if ids is not None:
+        query += ' AND c.id IN (SELECT value FROM json_each(?))'
+        params.append(json.dumps(ids))
+    query += ' ORDER BY c.last_message_at DESC'
+    return db.execute(query, params).fetchall()
+
+def query_friends(db, user_id, ids=None):
+    query = '''
+        SELECT u.id, u.username, u.display_name, u.user_code, u.online, u.avatar_color
+        FROM friends f
+        JOIN users u ON f.friend_id = u.id
+        WHERE f.user_id = ?
+    '''
+    params = [user_id]
+    if ids is not None:
+        query += ' AND f.friend_id IN (SELECT value FROM json_each(?))'
+        params.append(json.dumps(ids))
+    result = [dict(friend) for friend in db.execute(query, params).fetchall()]
+    # Live online state comes from the presence registry, not the flushed column
+    for friend in result:
+        friend['online'] = 1 if presence.is_online(friend['id']) else 0
+    return result
+
+def query_friend_requests(db, user_id, ids=None):
+    # Pending requests only; with ids, requests that are no longer pending
+    # are simply absent so the caller can treat them as removed
+    query = '''
+        SELECT CAST(fr.id AS TEXT) AS id, fr.from_user_id, fr.to_user_id, fr.status, fr.created_at,
+               u.display_name as from_display_name, u.avatar_color as from_avatar_color
+        FROM friend_requests fr
+        JOIN users u ON fr.from_user_id = u.id
+        WHERE fr.to_user_id = ? AND fr.status = 'pending'
+    '''
+    params = [user_id]
+    if ids is not None:
+        query += ' AND fr.id IN (SELECT value FROM json_each(?))'
+        params.append(json.dumps([parse_id(request_id) for request_id in ids]))
+    return db.execute(query, params).fetchall()
+
+def with_display_names(db, rows):
+    # Message rows come from a shard; sender names from the (cached) users.
+    # Ids go out as strings (see IdGenerator).
+    messages = []
+    for row in rows:
+        message = dict(row)
+        message['id'] = str(message['id'])
+        sender = get_user(db, message['user_id'])
+        message['display_name'] = sender['display_name'] if sender else None
+        messages.append(message)
+    return messages
+
+def query_message_page(db, conversation_id, before=None, after=None, limit=MESSAGE_PAGE_SIZE):
+    # Up to `limit` messages of a conversation from its shard and, past the
+    # archive boundary, from the archive: oldest first above `after`,
+    # otherwise newest first (below `before` if given)
+    boundary = message_archive.boundary(db)
+    rows = []
+    if after is not None and after < boundary:
+        rows = message_archive.page(db, conversation_id, after=after, limit=limit)
+    if len(rows) < limit and (before is None or before > boundary):
+        query = 'SELECT m.* FROM messages m WHERE m.conversation_id = ? AND m.id >= ?'
+        params = [conversation_id, boundary]
+        if after is not None:
+            query += ' AND m.id > ? ORDER BY m.id LIMIT ?'
+            params.append(after)
+        else:
+            if before is not None:
+                query += ' AND m.id < ?'
+                params.append(before)
+            query += ' ORDER BY m.id DESC LIMIT ?'
+        params.append(limit - len(rows))
+        with message_shards.connection(conversation_id) as shard:
+            rows.extend(shard.execute(query, params).fetchall())
+    if after is None and len(rows) < limit and boundary:
+        rows.extend(message_archive.page(db, conversation_id, before=min(before or boundary, boundary),
+                                         limit=limit - len(rows)))
+    return rows
+
+def fill_newest_messages(db, conversation_id):
+    # Load the newest page into the message cache (first read of a conversation)
+    message_cache.begin_fill(conversation_id)
+    rows = query_message_page(db, conversation_id, limit=message_cache.size + 1)
+    message_cache.fill(conversation_id, with_display_names(db, rows[:message_cache.size]),
+                       len(rows) > message_cache.size)
+
+def query_missed_messages(db, user_id, since, limit):
+    # Messages in the user's conversations logged after change seq `since`
+    changes = db.execute('''
+        SELECT ch.seq, ch.scope_id, ch.entity_id
+        FROM changes ch
+        WHERE ch.scope = 'conversation' AND ch.kind = 'message' AND ch.seq > ?
+          AND ch.scope_id IN (SELECT conversation_id FROM conversation_participants WHERE user_id = ?)
+        ORDER BY ch.seq
+        LIMIT ?
+    ''', (since, user_id, limit)).fetchall()
+    messages = {m['id']: m for m in query_messages_by_id(db, [(c['scope_id'], c['entity_id']) for c in changes])}
+    result = []
+    for change in changes:
+        message = messages.get(change['entity_id'])
+        if message is not None:
+            # The log is authoritative; the shard copy of seq is set last
+            message['seq'] = change['seq']
+            result.append(message)
+    return result
+
+def query_receipts(db, conversation_id):
+    return db.execute('''
+        SELECT user_id, delivered_seq, read_seq FROM conversation_participants
+        WHERE conversation_id = ?
+    ''', (conversation_id,)).fetchall()
+
+def query_messages_by_id(db, refs):
+    # refs are (conversation_id, message_id) pairs; each shard is asked once
+    # and archived ids go to the archive
+    boundary = message_archive.boundary(db)
+    refs = [(conversation_id, parse_id(message_id)) for conversation_id, message_id in refs]
+    archived = [message_id for _, message_id in refs if message_id is not None and message_id < boundary]
+    rows = message_archive.get(db, archived) if archived else []
+    hot = [ref for ref in refs if ref[1] is not None and ref[1] >= boundary]
+    for index, group in message_shards.group(hot, lambda ref: ref[0]).items():
+        with message_shards.pools[index].connection() as shard:
+            rows.extend(shard.execute('''
+                SELECT m.*
+                FROM messages m
+                WHERE m.id IN (SELECT value FROM json_each(?))
+            ''', (json.dumps([message_id for _, message_id in group]),)).fetchall())
+    rows.sort(key=lambda m: m['id'])
+    return with_display_names(db, rows)
+
+# Static assets
+class AssetRegistry:
+    # Files under static/ are read, hashed and compressed once at startup and
+    # served from memory. Versioned names (app.<hash>.js) never change
+    # content, so they are cached for a year as immutable; unversioned
+    # entries like the index page are revalidated with their ETag instead.
+    def __init__(self):
+        self._assets = {}  # served name -> asset
+        self._urls = {}  # logical name -> URL
+
+    def add(self, name, body, versioned=True):
+        digest = hashlib.sha256(body).hexdigest()[:16]
+        served = name
+        if versioned:
+            root, ext = os.path.splitext(name)
+            served = f"{root}.{digest}{ext}"
+        
+        encodings = {'identity': body}
+        compressed = gzip.compress(body, compresslevel=9, mtime=0)
+        if len(compressed) < len(body):
+            encodings['gzip'] = compressed
+        if brotli is not None:
+            compressed = brotli.compress(body, quality=11)
+            if len(compressed) < len(body):
+                encodings['br'] = compressed
+        
+        self._assets[served] = {
+            'mimetype': mimetypes.guess_type(name)[0] or 'application/octet-stream',
+            'etag': digest,
+            'encodings': encodings,
+            'immutable': versioned
+        }
+        if versioned:
+            self._urls[name] = '/assets/' + served
+
+    def load_directory(self, directory):
+        for root, _, files in os.walk(directory):
+            for filename in sorted(files):
+                path = os.path.join(root, filename)
+                name = os.path.relpath(path, directory).replace(os.sep, '/')
+                with open(path, 'rb') as f:
+                    self.add(name, f.read())
+
+    def url(self, name):
+        return self._urls[name]
+
+    def response(self, served):
+        asset = self._assets.get(served)
+        if asset is None:
+            abort(404)
+        
+        encoding = 'identity'
+        for candidate in ('br', 'gzip'):
+            if candidate in asset['encodings'] and request.accept_encodings[candidate]:
+                encoding = candidate
+                break
+        # Each encoding is a different representation, so it gets its own ETag
+        etag = asset['etag'] if encoding == 'identity' else f"{asset['etag']}-{encoding}"
+        
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            response = Response(asset['encodings'][encoding], mimetype=asset['mimetype'])
+            if encoding != 'identity':
+                response.headers['Content-Encoding'] = encoding
+        response.set_etag(etag)
+        response.vary.add('Accept-Encoding')
+        if asset['immutable']:
+            response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+        else:
+            response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+assets = AssetRegistry()
+assets.load_directory(os.path.join(app.root_path, 'static'))
+# The shell only references versioned asset URLs, so it is rendered once
+with app.app_context():
+    assets.add('index.html', render_template('index.html', asset_url=assets.url,
+                                             socket_options=client_socket_options()).encode('utf-8'),
+               versioned=False)
+
+# Conditional JSON responses
+# Data versions come from the change log: the newest sequence number that
+# touches a user (directly or through one of their conversations). Each MAX
+# is a single index seek, far cheaper than building and serializing a list.
+def user_scope_version(db, user_id):
+    return db.execute("SELECT MAX(seq) FROM changes WHERE scope = 'user' AND scope_id = ?",
+                      (user_id,)).fetchone()[0] or 0
+
+def conversation_version(db, conversation_id):
+    return db.execute("SELECT MAX(seq) FROM changes WHERE scope = 'conversation' AND scope_id = ?",
+                      (conversation_id,)).fetchone()[0] or 0
+
+def user_conversations_version(db, user_id):
+    return db.execute('''
+        SELECT MAX((SELECT MAX(seq) FROM changes
+                    WHERE scope = 'conversation' AND scope_id = cp.conversation_id))
+        FROM conversation_participants cp
+        WHERE cp.user_id = ?
+    ''', (user_id,)).fetchone()[0] or 0
+
+def versioned(version_fn):
+    # Tag the response with a weak ETag derived from version_fn(db, **view_args)
+    # and the full URL, and answer If-None-Match with 304 before the view
+    # runs. version_fn returns None when the request cannot be versioned.
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            version = version_fn(get_db(), **kwargs)
+            if version is None:
+                return view(*args, **kwargs)
+            etag = hashlib.sha1(f"{request.full_path}|{version}".encode('utf-8')).hexdigest()
+            if request.if_none_match.contains_weak(etag):
+                response = Response(status=304)
+            else:
+                response = make_response(view(*args, **kwargs))
+            response.set_etag(etag, weak=True)
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
+        return wrapper
+    return decorator
+
+def conversations_list_version(db):
+    user_id = request.args.get('user_id')
+    if not user_id:
+        return None
+    return user_conversations_version(db, user_id)
+
+def friends_list_version(db):
+    # Online flags come from presence, so the tag also covers which of the
+    # user's friends are online right now (the same on every worker)
+    user_id = request.args.get('user_id')
+    if not user_id:
+        return None
+    friend_ids = [row['friend_id'] for row in db.execute(
+        'SELECT friend_id FROM friends WHERE user_id = ?', (user_id,)).fetchall()]
+    online = hashlib.sha1('|'.join(sorted(presence.online_among(friend_ids))).encode('utf-8')).hexdigest()
+    return f"{user_scope_version(db, user_id)}:{online}"
+
+def friend_requests_list_version(db):
+    user_id = request.args.get('user_id')
+    if not user_id:
+        return None
+    return user_scope_version(db, user_id)
+
+def messages_page_version(db, conversation_id):
+    return conversation_version(db, conversation_id)
+
+@app.after_request
+def compress_json(response):
+    # gzip JSON bodies above the size threshold for clients that accept it
+    if (response.mimetype != 'application/json' or response.status_code != 200
+            or response.direct_passthrough or 'Content-Encoding' in response.headers):
+        return response
+    response.vary.add('Accept-Encoding')
+    if not request.accept_encodings['gzip']:
+        return response
+    body = response.get_data()
+    if len(body) < app.config['JSON_COMPRESS_MIN_SIZE']:
+        return response
+    response.set_data(gzip.compress(body, compresslevel=app.config['JSON_COMPRESS_LEVEL']))
+    response.headers['Content-Encoding'] = 'gzip'
+    return response
+
 # Routes
 @app.route('/')
 def index():
-    return '''
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <title>WhatsApp Clone</title>
-        <meta name="viewport" content="width=device-width, initial-scale=1.0">
-        <script src="https://cdnjs.cloudflare.com/ajax/libs/socket.io/4.0.1/socket.io.js"></script>
-        <style>
-            * { margin: 0; padding: 0; box-sizing: border-box; }
-            body { 
-                font-family: 'Segoe UI', sans-serif; 
-                background: #111b21; 
-                color: white;
-                height: 100vh;
-                overflow: hidden;
-            }
-            .app-container {
-                display: flex;
-                height: 100vh;
-                max-width: 1600px;
-                margin: 0 auto;
-                background: #222e35;
-            }
-            .sidebar {
-                width: 400px;
-                background: #2a3942;
-                border-right: 1px solid #333;
-                display: flex;
-                flex-direction: column;
-            }
-            .sidebar-header {
-                padding: 20px;
-                background: #202c33;
-                display: flex;
-                align-items: center;
-                gap: 15px;
-            }
-            .user-avatar {
-                width: 50px;
-                height: 50px;
-                border-radius: 50%;
-                display: flex;
-                align-items: center;
-                justify-content: center;
-                font-weight: bold;
-                font-size: 20px;
-                color: white;
-            }
-            .user-info {
-                flex: 1;
-            }
-            .user-name {
-                font-weight: 600;
-                font-size: 18px;
-            }
-            .user-status {
-                font-size: 14px;
-                color: #8696a0;
-            }
-            .user-code {
-                font-size: 12px;
-                color: #00a884;
-                margin-top: 2px;
-            }
-            .sidebar-tabs {
-                display: flex;
-                background: #202c33;
-            }
-            .tab {
-                flex: 1;
-                padding: 15px;
-                text-align: center;
-                cursor: pointer;
-                border-bottom: 3px solid transparent;
-                transition: all 0.3s;
-            }
-            .tab.active {
-                border-bottom-color: #00a884;
-                color: #00a884;
-            }
-            .search-box {
-                padding: 15px;
-                background: #202c33;
-            }
-            .search-box input {
-                width: 100%;
-                padding: 12px 20px;
-                background: #2a3942;
-                border: none;
-                border-radius: 20px;
-                color: white;
-                font-size: 14px;
-            }
-            .content-area {
-                flex: 1;
-                overflow-y: auto;
-            }
-            .conversation-item, .friend-item {
-                padding: 15px;
-                border-bottom: 1px solid #2a3942;
-                cursor: pointer;
-                display: flex;
-                align-items: center;
-                gap: 15px;
-                transition: background 0.2s;
-            }
-            .conversation-item:hover, .friend-item:hover {
-                background: #2a3942;
-            }
-            .conversation-item.active {
-                background: #2a3942;
-            }
-            .item-avatar {
-                width: 55px;
-                height: 55px;
-                border-radius: 50%;
-                display: flex;
-                align-items: center;
-                justify-content: center;
-                font-weight: bold;
-                font-size: 18px;
-                color: white;
-            }
-            .item-info {
-                flex: 1;
-            }
-            .item-name {
-                font-weight: 600;
-                font-size: 16px;
-                margin-bottom: 5px;
-            }
-            .item-preview {
-                font-size: 14px;
-                color: #8696a0;
-            }
-            .item-status {
-                font-size: 12px;
-                color: #00a884;
-            }
-            .chat-area {
-                flex: 1;
-                display: flex;
-                flex-direction: column;
-            }
-            .chat-header {
-                padding: 15px 20px;
-                background: #202c33;
-                border-bottom: 1px solid #2a3942;
-                display: flex;
-                align-items: center;
-                gap: 15px;
-            }
-            .chat-avatar {
-                width: 50px;
-                height: 50px;
-                border-radius: 50%;
-                display: flex;
-                align-items: center;
-                justify-content: center;
-                font-weight: bold;
-                font-size: 18px;
-                color: white;
-            }
-            .chat-info {
-                flex: 1;
-            }
-            .chat-name {
-                font-weight: 600;
-                font-size: 18px;
-            }
-            .chat-status {
-                font-size: 14px;
-                color: #8696a0;
-            }
-            .chat-actions {
-                display: flex;
-                gap: 10px;
-            }
-            .action-btn {
-                width: 40px;
-                height: 40px;
-                border-radius: 50%;
-                border: none;
-                background: #2a3942;
-                color: white;
-                cursor: pointer;
-                display: flex;
-                align-items: center;
-                justify-content: center;
-            }
-            .messages-container {
-                flex: 1;
-                padding: 20px;
-                overflow-y: auto;
-                background: #0b141a;
-                background-image: url('data:image/svg+xml,<svg xmlns="http://www.w3.org/2000/svg" width="100" height="100" opacity="0.03"><path fill="%2300a884" d="M50 0L100 50L50 100L0 50Z"/></svg>');
-            }
-            .message {
-                max-width: 65%;
-                margin-bottom: 15px;
-                padding: 12px 16px;
-                border-radius: 8px;
-                position: relative;
-                animation: fadeIn 0.3s;
-            }
-            @keyframes fadeIn {
-                from { opacity: 0; transform: translateY(10px); }
-                to { opacity: 1; transform: translateY(0); }
-            }
-            .message.sent {
-                background: #005c4b;
-                margin-left: auto;
-                border-top-right-radius: 0;
-            }
-            .message.received {
-                background: #202c33;
-                margin-right: auto;
-                border-top-left-radius: 0;
-            }
-            .message-content {
-                line-height: 1.4;
-            }
-            .message-time {
-                font-size: 11px;
-                color: #8696a0;
-                text-align: right;
-                margin-top: 5px;
-            }
-            .input-container {
-                padding: 15px 20px;
-                background: #202c33;
-                display: flex;
-                align-items: center;
-                gap: 15px;
-            }
-            .input-actions {
-                display: flex;
-                gap: 10px;
-            }
-            .input-action {
-                width: 40px;
-                height: 40px;
-                border-radius: 50%;
-                border: none;
-                background: #2a3942;
-                color: white;
-                cursor: pointer;
-                display: flex;
-                align-items: center;
-                justify-content: center;
-            }
-            .message-input {
-                flex: 1;
-                padding: 12px 20px;
-                background: #2a3942;
-                border: none;
-                border-radius: 20px;
-                color: white;
-                font-size: 15px;
-                resize: none;
-                max-height: 120px;
-            }
-            .send-btn {
-                width: 45px;
-                height: 45px;
-                border-radius: 50%;
-                border: none;
-                background: #00a884;
-                color: white;
-                cursor: pointer;
-                display: flex;
-                align-items: center;
-                justify-content: center;
-            }
-            .login-screen {
-                display: flex;
-                height: 100vh;
-                background: linear-gradient(135deg, #00a884 0%, #128c7e 100%);
-                align-items: center;
-                justify-content: center;
-            }
-            .login-box {
-                background: white;
-                padding: 40px;
-                border-radius: 15px;
-                box-shadow: 0 10px 30px rgba(0,0,0,0.3);
-                width: 90%;
-                max-width: 400px;
-                text-align: center;
-            }
-            .login-title {
-                color: #128c7e;
-                font-size: 32px;
-                font-weight: bold;
-                margin-bottom: 10px;
-            }
-            .login-subtitle {
-                color: #666;
-                margin-bottom: 30px;
-            }
-            .login-input {
-                width: 100%;
-                padding: 15px;
-                border: 1px solid #ddd;
-                border-radius: 8px;
-                margin-bottom: 15px;
-                font-size: 16px;
-            }
-            .login-btn {
-                width: 100%;
-                padding: 15px;
-                background: #00a884;
-                color: white;
-                border: none;
-                border-radius: 8px;
-                font-size: 16px;
-                font-weight: bold;
-                cursor: pointer;
-            }
-            .add-friend-btn {
-                position: fixed;
-                bottom: 20px;
-                right: 20px;
-                width: 60px;
-                height: 60px;
-                border-radius: 50%;
-                background: #00a884;
-                color: white;
-                border: none;
-                font-size: 24px;
-                cursor: pointer;
-                box-shadow: 0 4px 15px rgba(0,0,0,0.3);
-                z-index: 1000;
-            }
-            .friend-requests {
-                padding: 15px;
-            }
-            .friend-request-item {
-                background: #2a3942;
-                padding: 15px;
-                border-radius: 10px;
-                margin-bottom: 10px;
-                display: flex;
-                align-items: center;
-                gap: 15px;
-            }
-            .request-actions {
-                display: flex;
-                gap: 10px;
-                margin-left: auto;
-            }
-            .accept-btn, .decline-btn {
-                padding: 8px 15px;
-                border: none;
-                border-radius: 5px;
-                cursor: pointer;
-                font-size: 14px;
-            }
-            .accept-btn {
-                background: #00a884;
-                color: white;
-            }
-            .decline-btn {
-                background: #ff4444;
-                color: white;
-            }
-            .call-interface {
-                position: fixed;
-                top: 0;
-                left: 0;
-                width: 100%;
-                height: 100%;
-                background: #1a1a1a;
-                z-index: 2000;
-                display: none;
-                flex-direction: column;
-                align-items: center;
-                justify-content: center;
-            }
-            .caller-info {
-                text-align: center;
-                color: white;
-                margin-bottom: 30px;
-            }
-            .caller-name {
-                font-size: 24px;
-                font-weight: bold;
-                margin-bottom: 10px;
-            }
-            .call-status {
-                font-size: 16px;
-                color: #8696a0;
-            }
-            .call-controls {
-                display: flex;
-                gap: 20px;
-            }
-            .call-btn {
-                width: 60px;
-                height: 60px;
-                border-radius: 50%;
-                border: none;
-                cursor: pointer;
-                display: flex;
-                align-items: center;
-                justify-content: center;
-                font-size: 20px;
-            }
-            .accept-call {
-                background: #00a884;
-                color: white;
-            }
-            .decline-call {
-                background: #ff4444;
-                color: white;
-            }
-            .end-call {
-                background: #ff4444;
-                color: white;
-            }
-        </style>
-    </head>
-    <body>
-        <div id="loginScreen" class="login-screen">
-            <div class="login-box">
-                <div class="login-title">WhatsApp</div>
-                <div class="login-subtitle">Complete Messenger with All Features</div>
-                <input type="text" id="usernameInput" class="login-input" placeholder="Enter your name">
-                <button onclick="login()" class="login-btn">Get Started</button>
-            </div>
-        </div>
-
-        <div id="appContainer" class="app-container" style="display: none;">
-            <div class="sidebar">
-                <div class="sidebar-header">
-                    <div class="user-avatar" id="userAvatar" style="background: #FF6B6B;">U</div>
-                    <div class="user-info">
-                        <div class="user-name" id="userName">User</div>
-                        <div class="user-status" id="userStatus">Online</div>
-                        <div class="user-code" id="userCode">CODE: --------</div>
-                    </div>
-                </div>
-                
-                <div class="sidebar-tabs">
-                    <div class="tab active" onclick="switchTab('chats')">Chats</div>
-                    <div class="tab" onclick="switchTab('friends')">Friends</div>
-                    <div class="tab" onclick="switchTab('requests')">Requests</div>
-                </div>
-                
-                <div class="search-box">
-                    <input type="text" id="searchInput" placeholder="Search...">
-                </div>
-                
-                <div class="content-area" id="contentArea">
-                    <!-- Content will be loaded here -->
-                </div>
-            </div>
-            
-            <div class="chat-area">
-                <div class="chat-header">
-                    <div class="chat-avatar" id="chatAvatar" style="background: #4ECDC4;">C</div>
-                    <div class="chat-info">
-                        <div class="chat-name" id="chatName">Select a chat</div>
-                        <div class="chat-status" id="chatStatus">Click on a conversation to start messaging</div>
-                    </div>
-                    <div class="chat-actions" id="chatActions" style="display: none;">
-                        <button class="action-btn" onclick="startVoiceCall()" title="Voice call">📞</button>
-                        <button class="action-btn" onclick="startVideoCall()" title="Video call">📹</button>
-                    </div>
-                </div>
-                
-                <div class="messages-container" id="messagesContainer">
-                    <div style="text-align: center; color: #8696a0; padding: 40px;">
-                        Select a conversation to start messaging
-                    </div>
-                </div>
-                
-                <div class="input-container" id="inputContainer" style="display: none;">
-                    <div class="input-actions">
-                        <button class="input-action" title="Emoji">😊</button>
-                        <button class="input-action" title="Attach">📎</button>
-                    </div>
-                    <textarea class="message-input" id="messageInput" placeholder="Type a message..." rows="1"></textarea>
-                    <button class="send-btn" onclick="sendMessage()" title="Send">➤</button>
-                </div>
-            </div>
-        </div>
-
-        <!-- Call Interface -->
-        <div id="callInterface" class="call-interface">
-            <div class="caller-info">
-                <div class="caller-name" id="callerName">John Doe</div>
-                <div class="call-status" id="callStatus">Calling...</div>
-            </div>
-            <div class="call-controls">
-                <button class="call-btn accept-call" onclick="answerCall(true)">📞</button>
-                <button class="call-btn decline-call" onclick="answerCall(false)">📞</button>
-                <button class="call-btn end-call" onclick="endCall()" style="display: none;">📞</button>
-            </div>
-        </div>
-
-        <button class="add-friend-btn" onclick="showAddFriend()" title="Add Friend">+</button>
-
-        <script>
-            let currentUser = null;
-            let socket = null;
-            let currentConversation = null;
-            let currentCall = null;
-            let conversations = [];
-            let friends = [];
-            let friendRequests = [];
-
-            // Initialize app
-            function initApp() {
-                const savedUser = localStorage.getItem('whatsappUser');
-                if (savedUser) {
-                    currentUser = JSON.parse(savedUser);
-                    showApp();
-                    connectSocket();
-                    loadData();
-                }
-            }
-
-            function login() {
-                const username = document.getElementById('usernameInput').value.trim();
-                if (!username) {
-                    alert('Please enter your name');
-                    return;
-                }
-
-                fetch('/api/login', {
-                    method: 'POST',
-                    headers: {'Content-Type': 'application/json'},
-                    body: JSON.stringify({username: username})
-                })
-                .then(r => r.json())
-                .then(data => {
-                    if (data.success) {
-                        currentUser = data.user;
-                        localStorage.setItem('whatsappUser', JSON.stringify(data.user));
-                        showApp();
-                        connectSocket();
-                        loadData();
-                    } else {
-                        alert('Error: ' + data.error);
-                    }
-                });
-            }
-
-            function showApp() {
-                document.getElementById('loginScreen').style.display = 'none';
-                document.getElementById('appContainer').style.display = 'flex';
-                
-                document.getElementById('userName').textContent = currentUser.display_name;
-                document.getElementById('userAvatar').textContent = currentUser.display_name.charAt(0).toUpperCase();
-                document.getElementById('userAvatar').style.background = currentUser.avatar_color;
-                document.getElementById('userCode').textContent = 'CODE: ' + currentUser.user_code;
-                document.getElementById('userStatus').textContent = 'Online';
-
-                loadConversations();
-            }
-
-            function connectSocket() {
-                socket = io({query: {user_id: currentUser.id}});
-                
-                socket.on('connect', () => {
-                    console.log('Connected to server');
-                    updateOnlineStatus(true);
-                });
-
-                socket.on('new_message', handleNewMessage);
-                socket.on('friend_request', handleFriendRequest);
-                socket.on('friend_request_accepted', handleFriendRequestAccepted);
-                socket.on('incoming_call', handleIncomingCall);
-                socket.on('call_accepted', handleCallAccepted);
-                socket.on('call_ended', handleCallEnded);
-            }
-
-            function loadData() {
-                loadConversations();
-                loadFriends();
-                loadFriendRequests();
-            }
-
-            function loadConversations() {
-                fetch('/api/conversations?user_id=' + currentUser.id)
-                .then(r => r.json())
-                .then(data => {
-                    if (data.success) {
-                        conversations = data.conversations;
-                        renderConversations();
-                    }
-                });
-            }
-
-            function loadFriends() {
-                fetch('/api/friends?user_id=' + currentUser.id)
-                .then(r => r.json())
-                .then(data => {
-                    if (data.success) {
-                        friends = data.friends;
-                    }
-                });
-            }
-
-            function loadFriendRequests() {
-                fetch('/api/friend_requests?user_id=' + currentUser.id)
-                .then(r => r.json())
-                .then(data => {
-                    if (data.success) {
-                        friendRequests = data.requests;
-                    }
-                });
-            }
-
-            function renderConversations() {
-                const container = document.getElementById('contentArea');
-                container.innerHTML = conversations.map(conv => `
-                    <div class="conversation-item" onclick="selectConversation('${conv.id}')">
-                        <div class="item-avatar" style="background: ${conv.avatar_color || '#4ECDC4'};">${conv.name.charAt(0).toUpperCase()}</div>
-                        <div class="item-info">
-                            <div class="item-name">${conv.name}</div>
-                            <div class="item-preview">${conv.last_message || 'No messages yet'}</div>
-                        </div>
-                    </div>
-                `).join('');
-            }
-
-            function renderFriends() {
-                const container = document.getElementById('contentArea');
-                container.innerHTML = friends.map(friend => `
-                    <div class="friend-item" onclick="startChatWithFriend('${friend.id}')">
-                        <div class="item-avatar" style="background: ${friend.avatar_color || '#45B7D1'};">${friend.display_name.charAt(0).toUpperCase()}</div>
-                        <div class="item-info">
-                            <div class="item-name">${friend.display_name}</div>
-                            <div class="item-status">${friend.online ? 'Online' : 'Offline'}</div>
-                            <div class="item-preview">Code: ${friend.user_code}</div>
-                        </div>
-                    </div>
-                `).join('');
-            }
-
-            function renderFriendRequests() {
-                const container = document.getElementById('contentArea');
-                if (friendRequests.length === 0) {
-                    container.innerHTML = '<div style="text-align: center; color: #8696a0; padding: 40px;">No pending friend requests</div>';
-                    return;
-                }
-
-                container.innerHTML = friendRequests.map(req => `
-                    <div class="friend-request-item">
-                        <div class="item-avatar" style="background: ${req.from_avatar_color || '#FF6B6B'};">${req.from_display_name.charAt(0).toUpperCase()}</div>
-                        <div class="item-info">
-                            <div class="item-name">${req.from_display_name}</div>
-                            <div class="item-preview">Wants to be your friend</div>
-                        </div>
-                        <div class="request-actions">
-                            <button class="accept-btn" onclick="respondToRequest('${req.id}', true)">Accept</button>
-                            <button class="decline-btn" onclick="respondToRequest('${req.id}', false)">Decline</button>
-                        </div>
-                    </div>
-                `).join('');
-            }
-
-            function switchTab(tabName) {
-                document.querySelectorAll('.tab').forEach(tab => tab.classList.remove('active'));
-                event.target.classList.add('active');
-
-                if (tabName === 'chats') {
-                    renderConversations();
-                } else if (tabName === 'friends') {
-                    renderFriends();
-                } else if (tabName === 'requests') {
-                    renderFriendRequests();
-                }
-            }
-
-            function selectConversation(conversationId) {
-                currentConversation = conversations.find(c => c.id === conversationId);
-                if (!currentConversation) return;
-
-                document.getElementById('chatName').textContent = currentConversation.name;
-                document.getElementById('chatAvatar').textContent = currentConversation.name.charAt(0).toUpperCase();
-                document.getElementById('chatAvatar').style.background = currentConversation.avatar_color || '#4ECDC4';
-                document.getElementById('chatStatus').textContent = 'Online';
-                document.getElementById('chatActions').style.display = 'flex';
-                document.getElementById('inputContainer').style.display = 'flex';
-
-                loadMessages(conversationId);
-            }
-
-            function loadMessages(conversationId) {
-                fetch('/api/messages/' + conversationId)
-                .then(r => r.json())
-                .then(data => {
-                    if (data.success) {
-                        renderMessages(data.messages);
-                    }
-                });
-            }
-
-            function renderMessages(messages) {
-                const container = document.getElementById('messagesContainer');
-                container.innerHTML = messages.map(msg => `
-                    <div class="message ${msg.user_id === currentUser.id ? 'sent' : 'received'}">
-                        <div class="message-content">${msg.content}</div>
-                        <div class="message-time">${formatTime(msg.timestamp)}</div>
-                    </div>
-                `).join('');
-                
-                container.scrollTop = container.scrollHeight;
-            }
-
-            function sendMessage() {
-                const input = document.getElementById('messageInput');
-                const content = input.value.trim();
-                
-                if (!content || !currentConversation) return;
-
-                const messageData = {
-                    id: 'msg_' + Date.now(),
-                    conversation_id: currentConversation.id,
-                    user_id: currentUser.id,
-                    content: content,
-                    timestamp: new Date().toISOString()
-                };
-
-                // Add to UI immediately
-                addMessageToUI(messageData, true);
-                input.value = '';
-
-                // Send to server
-                fetch('/api/send_message', {
-                    method: 'POST',
-                    headers: {'Content-Type': 'application/json'},
-                    body: JSON.stringify(messageData)
-                });
-
-                if (socket) {
-                    socket.emit('send_message', messageData);
-                }
-            }
-
-            function addMessageToUI(messageData, isSent) {
-                const container = document.getElementById('messagesContainer');
-                const placeholder = container.querySelector('div[style]');
-                if (placeholder) placeholder.remove();
-
-                const messageDiv = document.createElement('div');
-                messageDiv.className = `message ${isSent ? 'sent' : 'received'}`;
-                messageDiv.innerHTML = `
-                    <div class="message-content">${messageData.content}</div>
-                    <div class="message-time">${formatTime(messageData.timestamp)}</div>
-                `;
-                
-                container.appendChild(messageDiv);
-                container.scrollTop = container.scrollHeight;
-            }
-
-            function handleNewMessage(data) {
-                if (currentConversation && data.conversation_id === currentConversation.id) {
-                    addMessageToUI(data.message, false);
-                }
-            }
-
-            function showAddFriend() {
-                const userCode = prompt('Enter friend\'s code:');
-                if (userCode) {
-                    fetch('/api/send_friend_request', {
-                        method: 'POST',
-                        headers: {'Content-Type': 'application/json'},
-                        body: JSON.stringify({
-                            from_user_id: currentUser.id,
-                            to_user_code: userCode
-                        })
-                    })
-                    .then(r => r.json())
-                    .then(data => {
-                        if (data.success) {
-                            alert('Friend request sent!');
-                            loadFriendRequests();
-                        } else {
-                            alert('Error: ' + data.error);
-                        }
-                    });
-                }
-            }
-
-            function respondToRequest(requestId, accept) {
-                fetch('/api/respond_friend_request', {
-                    method: 'POST',
-                    headers: {'Content-Type': 'application/json'},
-                    body: JSON.stringify({
-                        request_id: requestId,
-                        accept: accept
-                    })
-                })
-                .then(r => r.json())
-                .then(data => {
-                    if (data.success) {
-                        loadFriendRequests();
-                        loadFriends();
-                        if (accept) {
-                            alert('Friend added successfully!');
-                        }
-                    }
-                });
-            }
-
-            function handleFriendRequest(data) {
-                loadFriendRequests();
-                alert(`New friend request from ${data.from_user.display_name}`);
-            }
-
-            function handleFriendRequestAccepted(data) {
-                loadFriends();
-                alert(`${data.friend.display_name} accepted your friend request!`);
-            }
-
-            function startChatWithFriend(friendId) {
-                fetch('/api/create_conversation', {
-                    method: 'POST',
-                    headers: {'Content-Type': 'application/json'},
-                    body: JSON.stringify({
-                        user_id: currentUser.id,
-                        friend_id: friendId
-                    })
-                })
-                .then(r => r.json())
-                .then(data => {
-                    if (data.success) {
-                        loadConversations();
-                        // Switch to chats tab and select the conversation
-                        document.querySelectorAll('.tab')[0].click();
-                        // You might want to automatically select the new conversation here
-                    }
-                });
-            }
-
-            function startVoiceCall() {
-                if (!currentConversation) return;
-                
-                fetch('/api/start_call', {
-                    method: 'POST',
-                    headers: {'Content-Type': 'application/json'},
-                    body: JSON.stringify({
-                        from_user_id: currentUser.id,
-                        conversation_id: currentConversation.id,
-                        call_type: 'voice'
-                    })
-                })
-                .then(r => r.json())
-                .then(data => {
-                    if (data.success) {
-                        currentCall = data.call;
-                        showCallInterface('outgoing');
-                    }
-                });
-            }
-
-            function startVideoCall() {
-                if (!currentConversation) return;
-                
-                fetch('/api/start_call', {
-                    method: 'POST',
-                    headers: {'Content-Type': 'application/json'},
-                    body: JSON.stringify({
-                        from_user_id: currentUser.id,
-                        conversation_id: currentConversation.id,
-                        call_type: 'video'
-                    })
-                })
-                .then(r => r.json())
-                .then(data => {
-                    if (data.success) {
-                        currentCall = data.call;
-                        showCallInterface('outgoing');
-                    }
-                });
-            }
-
-            function handleIncomingCall(data) {
-                currentCall = data.call;
-                document.getElementById('callerName').textContent = data.caller.display_name;
-                document.getElementById('callStatus').textContent = `Incoming ${data.call.call_type} call`;
-                showCallInterface('incoming');
-            }
-
-            function showCallInterface(type) {
-                const callInterface = document.getElementById('callInterface');
-                const acceptBtn = callInterface.querySelector('.accept-call');
-                const declineBtn = callInterface.querySelector('.decline-call');
-                const endBtn = callInterface.querySelector('.end-call');
-                
-                if (type === 'incoming') {
-                    acceptBtn.style.display = 'flex';
-                    declineBtn.style.display = 'flex';
-                    endBtn.style.display = 'none';
-                    document.getElementById('callStatus').textContent = 'Incoming call';
-                } else {
-                    acceptBtn.style.display = 'none';
-                    declineBtn.style.display = 'none';
-                    endBtn.style.display = 'flex';
-                    document.getElementById('callStatus').textContent = 'Calling...';
-                }
-                
-                callInterface.style.display = 'flex';
-            }
-
-            function answerCall(accept) {
-                if (!currentCall) return;
-                
-                fetch('/api/answer_call', {
-                    method: 'POST',
-                    headers: {'Content-Type': 'application/json'},
-                    body: JSON.stringify({
-                        call_id: currentCall.id,
-                        accept: accept
-                    })
-                })
-                .then(r => r.json())
-                .then(data => {
-                    if (data.success) {
-                        if (accept) {
-                            document.getElementById('callStatus').textContent = 'Call connected';
-                            document.querySelector('.accept-call').style.display = 'none';
-                            document.querySelector('.decline-call').style.display = 'none';
-                            document.querySelector('.end-call').style.display = 'flex';
-                        } else {
-                            hideCallInterface();
-                        }
-                    }
-                });
-            }
-
-            function endCall() {
-                if (!currentCall) return;
-                
-                fetch('/api/end_call', {
-                    method: 'POST',
-                    headers: {'Content-Type': 'application/json'},
-                    body: JSON.stringify({
-                        call_id: currentCall.id
-                    })
-                })
-                .then(r => r.json())
-                .then(data => {
-                    hideCallInterface();
-                });
-            }
-
-            function handleCallAccepted(data) {
-                document.getElementById('callStatus').textContent = 'Call connected';
-                document.querySelector('.accept-call').style.display = 'none';
-                document.querySelector('.decline-call').style.display = 'none';
-                document.querySelector('.end-call').style.display = 'flex';
-            }
-
-            function handleCallEnded(data) {
-                hideCallInterface();
-                alert('Call ended');
-            }
-
-            function hideCallInterface() {
-                document.getElementById('callInterface').style.display = 'none';
-                currentCall = null;
-            }
-
-            function formatTime(timestamp) {
-                const date = new Date(timestamp);
-                return date.toLocaleTimeString([], {hour: '2-digit', minute:'2-digit'});
-            }
-
-            function updateOnlineStatus(online) {
-                if (socket) {
-                    socket.emit('user_status', {online: online});
-                }
-            }
-
-            // Auto-resize textarea and enter to send
-            document.addEventListener('DOMContentLoaded', function() {
-                const textarea = document.getElementById('messageInput');
-                textarea.addEventListener('input', function() {
-                    this.style.height = 'auto';
-                    this.style.height = (this.scrollHeight) + 'px';
-                });
-
-                textarea.addEventListener('keypress', function(e) {
-                    if (e.key === 'Enter' && !e.shiftKey) {
-                        e.preventDefault();
-                        sendMessage();
-                    }
-                });
-
-                initApp();
-            });
-        </script>
-    </body>
-    </html>
-    '''
+    return assets.response('index.html')
+
+@app.route('/assets/<path:filename>')
+def asset(filename):
+    return assets.response(filename)
 
 # API Routes
 @app.route('/api/login', methods=['POST'])
@@ -1102,130 +2677,244 @@ def api_login():
                    (user_id, username, username, user_code, 1, datetime.now().isoformat(), avatar_color, datetime.now().isoformat()))
         db.commit()
         user = db.execute('SELECT * FROM users WHERE id = ?', (user_id,)).fetchone()
-    else:
-        # Update online status
-        db.execute('UPDATE users SET online = 1, last_seen = ? WHERE id = ?
-                           db.execute('UPDATE users SET online = 1, last_seen = ? WHERE id = ?', 
-                   (datetime.now().isoformat(), user['id']))
-        db.commit()
-        user = db.execute('SELECT * FROM users WHERE id = ?', (user['id'],)).fetchone()
     
+    invalidate_user(user['id'])
+    # last_seen is written back by the presence flusher
+    presence.touch(user['id'])
     user_dict = dict(user)
-    db.close()
+    user_dict['online'] = 1
+    user_dict['last_seen'] = datetime.now().isoformat()
     return jsonify({'success': True, 'user': user_dict})
 
 @app.route('/api/conversations')
+@versioned(conversations_list_version)
 def api_conversations():
     user_id = request.args.get('user_id')
     if not user_id:
         return jsonify({'success': False, 'error': 'User ID required'})
     
     db = get_db()
-    
-    # Get user's conversations
-    conversations = db.execute('''
-        SELECT c.*, 
-               (SELECT content FROM messages WHERE conversation_id = c.id ORDER BY timestamp DESC LIMIT 1) as last_message
-        FROM conversations c
-        JOIN conversation_participants cp ON c.id = cp.conversation_id
-        WHERE cp.user_id = ?
-        ORDER BY (SELECT timestamp FROM messages WHERE conversation_id = c.id ORDER BY timestamp DESC LIMIT 1) DESC
-    ''', (user_id,)).fetchall()
-    
-    result = []
-    for conv in conversations:
-        conv_dict = dict(conv)
-        # Get conversation participants for individual chats
-        if not conv_dict['is_group']:
-            participants = db.execute('''
-                SELECT u.display_name, u.avatar_color 
-                FROM conversation_participants cp
-                JOIN users u ON cp.user_id = u.id
-                WHERE cp.conversation_id = ? AND cp.user_id != ?
-            ''', (conv_dict['id'], user_id)).fetchone()
-            if participants:
-                conv_dict['name'] = participants['display_name']
-                conv_dict['avatar_color'] = participants['avatar_color']
-        result.append(conv_dict)
-    
-    db.close()
+    result = query_conversations(db, user_id)
     return jsonify({'success': True, 'conversations': result})
 
 @app.route('/api/messages/<conversation_id>')
+@versioned(messages_page_version)
 def api_messages(conversation_id):
+    # Keyset pagination on the message id. Without cursors the newest page is
+    # returned; ?before= walks back into history and ?after= fetches newer
+    # messages. Each page is returned oldest first.
+    try:
+        limit = int(request.args.get('limit', MESSAGE_PAGE_SIZE))
+    except ValueError:
+        return jsonify({'success': False, 'error': 'Invalid limit'})
+    limit = max(1, min(limit, MESSAGE_PAGE_MAX))
+    
+    before = request.args.get('before')
+    after = request.args.get('after')
+    if before and after:
+        return jsonify({'success': False, 'error': 'Use either before or after, not both'})
+    cursor = decode_message_cursor(before or after)
+    if (before or after) and cursor is None:
+        return jsonify({'success': False, 'error': 'Invalid cursor'})
+    
+    if cursor is None:
+        # The newest page comes from the hot-conversation cache when possible
+        cached = message_cache.get(conversation_id, limit)
+        if cached is None:
+            fill_newest_messages(get_db(), conversation_id)
+            cached = message_cache.get(conversation_id, limit)
+        if cached is not None:
+            result, has_more = cached
+            return jsonify({
+                'success': True,
+                'messages': result,
+                'has_more': has_more,
+                'before_cursor': encode_message_cursor(result[0]) if result else None,
+                'after_cursor': encode_message_cursor(result[-1]) if result else None,
+                'receipts': query_receipts(get_db(), conversation_id)
+            })
+    
+    # Fetch one extra row to know whether another page exists
     db = get_db()
-    messages = db.execute('''
-        SELECT m.*, u.display_name 
-        FROM messages m 
-        JOIN users u ON m.user_id = u.id 
-        WHERE m.conversation_id = ? 
-        ORDER BY m.timestamp
-    ''', (conversation_id,)).fetchall()
+    messages = query_message_page(db, conversation_id, before=cursor if before else None,
+                                  after=cursor if after else None, limit=limit + 1)
+    
+    has_more = len(messages) > limit
+    result = with_display_names(db, messages[:limit])
+    if not after:
+        result.reverse()
     
-    result = [dict(msg) for msg in messages]
-    db.close()
-    return jsonify({'success': True, 'messages': result})
+    return jsonify({
+        'success': True,
+        'messages': result,
+        'has_more': has_more,
+        'before_cursor': encode_message_cursor(result[0]) if result else before,
+        'after_cursor': encode_message_cursor(result[-1]) if result else after,
+        'receipts': query_receipts(db, conversation_id)
+    })
+
+@app.route('/api/search')
+def api_search():
+    # Ranked full-text search over the messages of the user's conversations
+    # (optionally one of them). Pages are ranked, so they are addressed by
+    # offset; next_offset is set while more results exist.
+    user_id = request.args.get('user_id')
+    if not user_id:
+        return jsonify({'success': False, 'error': 'User ID required'})
+    match = fts_query(request.args.get('q'))
+    if not match:
+        return jsonify({'success': True, 'results': [], 'has_more': False, 'next_offset': None})
+    try:
+        limit = max(1, min(int(request.args.get('limit', SEARCH_PAGE_SIZE)), SEARCH_PAGE_MAX))
+        offset = max(0, int(request.args.get('offset', 0)))
+    except ValueError:
+        return jsonify({'success': False, 'error': 'Invalid limit or offset'})
+    
+    db = get_db()
+    conversation_ids = [row['conversation_id'] for row in db.execute(
+        'SELECT conversation_id FROM conversation_participants WHERE user_id = ?', (user_id,)).fetchall()]
+    conversation_id = request.args.get('conversation_id')
+    if conversation_id:
+        conversation_ids = [c for c in conversation_ids if c == conversation_id]
+    
+    # Each shard and archive segment ranks its own matches; the best
+    # offset + limit + 1 of each are merged by rank and the page is cut from
+    # that. Shard copies of archived messages are left to the archive.
+    boundary = message_archive.boundary(db)
+    rows = message_archive.search(db, match, request.args.get('q'), conversation_ids,
+                                  offset + limit + 1) if boundary and conversation_ids else []
+    for index, group in message_shards.group(conversation_ids, lambda c: c).items():
+        with message_shards.pools[index].connection() as shard:
+            rows.extend(shard.execute('''
+                SELECT m.id, m.conversation_id, m.user_id, m.timestamp, m.seq,
+                       snippet(messages_fts, 0, ?, ?, '…', 16) AS snippet, f.rank
+                FROM messages_fts f
+                JOIN messages m ON m.id = f.rowid
+                WHERE messages_fts MATCH ? AND f.rowid >= ?
+                  AND f.conversation_id IN (SELECT value FROM json_each(?))
+                ORDER BY f.rank
+                LIMIT ?
+            ''', (SNIPPET_START, SNIPPET_END, match, boundary, json.dumps(group), offset + limit + 1)).fetchall())
+    rows.sort(key=lambda row: row['rank'])
+    rows = rows[offset:offset + limit + 1]
+    has_more = len(rows) > limit
+    results = with_display_names(db, rows[:limit])
+    for result in results:
+        result['snippet'] = snippet_html(result['snippet'])
+        del result['rank']
+    
+    return jsonify({
+        'success': True,
+        'results': results,
+        'has_more': has_more,
+        'next_offset': offset + limit if has_more else None
+    })
 
 @app.route('/api/send_message', methods=['POST'])
 def api_send_message():
+    # REST path for clients without a socket; the web client sends over Socket.IO
     data = request.get_json()
     
-    db = get_db()
-    db.execute('INSERT INTO messages (id, conversation_id, user_id, content, timestamp) VALUES (?, ?, ?, ?, ?)',
-               (data['id'], data['conversation_id'], data['user_id'], data['content'], data['timestamp']))
-    db.commit()
+    try:
+        message = deliver_message(data)
+    except sqlite3.Error as e:
+        return jsonify({'success': False, 'error': str(e)})
     
-    # Get conversation participants
-    participants = db.execute('SELECT user_id FROM conversation_participants WHERE conversation_id = ?', 
-                             (data['conversation_id'],)).fetchall()
-    
-    # Broadcast to participants
-    for participant in participants:
-        if participant['user_id'] != data['user_id']:  # Don't send to sender
-            socketio.emit('new_message', {
-                'conversation_id': data['conversation_id'],
-                'message': data
-            }, room=participant['user_id'])
-    
-    db.close()
-    return jsonify({'success': True})
+    return jsonify({'success': True, 'message': message})
 
 @app.route('/api/friends')
+@versioned(friends_list_version)
 def api_friends():
     user_id = request.args.get('user_id')
     if not user_id:
         return jsonify({'success': False, 'error': 'User ID required'})
     
     db = get_db()
-    friends = db.execute('''
-        SELECT u.id, u.username, u.display_name, u.user_code, u.online, u.avatar_color
-        FROM friends f
-        JOIN users u ON f.friend_id = u.id
-        WHERE f.user_id = ?
-    ''', (user_id,)).fetchall()
-    
-    result = [dict(friend) for friend in friends]
-    db.close()
+    result = query_friends(db, user_id)
     return jsonify({'success': True, 'friends': result})
 
 @app.route('/api/friend_requests')
+@versioned(friend_requests_list_version)
 def api_friend_requests():
     user_id = request.args.get('user_id')
     if not user_id:
         return jsonify({'success': False, 'error': 'User ID required'})
     
     db = get_db()
-    requests = db.execute('''
-        SELECT fr.*, u.display_name as from_display_name, u.avatar_color as from_avatar_color
-        FROM friend_requests fr
-        JOIN users u ON fr.from_user_id = u.id
-        WHERE fr.to_user_id = ? AND fr.status = 'pending'
-    ''', (user_id,)).fetchall()
-    
-    result = [dict(req) for req in requests]
-    db.close()
+    result = query_friend_requests(db, user_id)
     return jsonify({'success': True, 'requests': result})
 
+@app.route('/api/sync')
+def api_sync():
+    # Delta sync: everything that changed for the user since ?since=<cursor>.
+    # since=0 (or a cursor older than the change log) returns a full snapshot
+    # with reset=true. Clients loop while has_more is set.
+    user_id = request.args.get('user_id')
+    if not user_id:
+        return jsonify({'success': False, 'error': 'User ID required'})
+    try:
+        since = int(request.args.get('since', 0))
+    except ValueError:
+        return jsonify({'success': False, 'error': 'Invalid cursor'})
+    
+    db = get_db()
+    bounds = db.execute('SELECT MIN(seq) AS oldest, MAX(seq) AS latest FROM changes').fetchone()
+    latest = bounds['latest'] or 0
+    
+    if since <= 0 or (bounds['oldest'] is not None and since < bounds['oldest'] - 1):
+        # The cursor is read before the snapshot, so anything written while it
+        # is being built is replayed by the next delta (applying it is idempotent)
+        return jsonify({
+            'success': True,
+            'reset': True,
+            'cursor': latest,
+            'has_more': False,
+            'conversations': query_conversations(db, user_id),
+            'messages': [],
+            'friends': query_friends(db, user_id),
+            'friend_requests': query_friend_requests(db, user_id),
+            'removed_friend_requests': []
+        })
+    
+    changes = db.execute('''
+        SELECT seq, scope, scope_id, kind, entity_id FROM changes
+        WHERE seq > ? AND ((scope = 'user' AND scope_id = ?)
+              OR (scope = 'conversation' AND scope_id IN
+                  (SELECT conversation_id FROM conversation_participants WHERE user_id = ?)))
+        ORDER BY seq
+        LIMIT ?
+    ''', (since, user_id, user_id, SYNC_BATCH_SIZE + 1)).fetchall()
+    
+    has_more = len(changes) > SYNC_BATCH_SIZE
+    changes = changes[:SYNC_BATCH_SIZE]
+    
+    conversation_ids, message_refs, friend_ids, request_ids = set(), [], set(), set()
+    for change in changes:
+        if change['scope'] == 'conversation':
+            conversation_ids.add(change['scope_id'])
+        if change['kind'] == 'message':
+            message_refs.append((change['scope_id'], change['entity_id']))
+        elif change['kind'] == 'friend':
+            friend_ids.add(change['entity_id'])
+        elif change['kind'] == 'friend_request':
+            request_ids.add(change['entity_id'])
+    
+    friend_requests = query_friend_requests(db, user_id, list(request_ids)) if request_ids else []
+    pending_ids = {req['id'] for req in friend_requests}
+    
+    return jsonify({
+        'success': True,
+        'reset': False,
+        # With no matching changes, skip ahead to the latest sequence number
+        'cursor': changes[-1]['seq'] if has_more else max([latest, since] + [c['seq'] for c in changes[-1:]]),
+        'has_more': has_more,
+        'conversations': query_conversations(db, user_id, list(conversation_ids)) if conversation_ids else [],
+        'messages': query_messages_by_id(db, message_refs) if message_refs else [],
+        'friends': query_friends(db, user_id, list(friend_ids)) if friend_ids else [],
+        'friend_requests': friend_requests,
+        'removed_friend_requests': sorted(request_ids - pending_ids)
+    })
+
 @app.route('/api/send_friend_request', methods=['POST'])
 def api_send_friend_request():
     data = request.get_json()
@@ -1258,25 +2947,25 @@ def api_send_friend_request():
         return jsonify({'success': False, 'error': 'Friend request already sent'})
     
     # Create friend request
-    request_id = str(uuid.uuid4())
+    request_id = str(id_generator.next())
     db.execute('INSERT INTO friend_requests (id, from_user_id, to_user_id, status, created_at) VALUES (?, ?, ?, "pending", ?)',
-               (request_id, from_user_id, to_user['id'], datetime.now().isoformat()))
+               (int(request_id), from_user_id, to_user['id'], datetime.now().isoformat()))
+    record_change(db, 'user', to_user['id'], 'friend_request', request_id)
     db.commit()
     
     # Notify target user
-    from_user = db.execute('SELECT * FROM users WHERE id = ?', (from_user_id,)).fetchone()
+    from_user = get_user(db, from_user_id)
     socketio.emit('friend_request', {
         'request_id': request_id,
-        'from_user': dict(from_user)
+        'from_user': plain(from_user)
     }, room=to_user['id'])
     
-    db.close()
     return jsonify({'success': True, 'message': 'Friend request sent'})
 
 @app.route('/api/respond_friend_request', methods=['POST'])
 def api_respond_friend_request():
     data = request.get_json()
-    request_id = data.get('request_id')
+    request_id = parse_id(data.get('request_id'))
     accept = data.get('accept', False)
     
     db = get_db()
@@ -1292,18 +2981,23 @@ def api_respond_friend_request():
                   (request_data['from_user_id'], request_data['to_user_id'], datetime.now().isoformat()))
         db.execute('INSERT OR IGNORE INTO friends (user_id, friend_id, created_at) VALUES (?, ?, ?)',
                   (request_data['to_user_id'], request_data['from_user_id'], datetime.now().isoformat()))
+        record_change(db, 'user', request_data['from_user_id'], 'friend', request_data['to_user_id'])
+        record_change(db, 'user', request_data['to_user_id'], 'friend', request_data['from_user_id'])
+        
+        invalidate_user(request_data['from_user_id'])
+        invalidate_user(request_data['to_user_id'])
         
         # Notify the requester
-        new_friend = db.execute('SELECT * FROM users WHERE id = ?', (request_data['to_user_id'],)).fetchone()
+        new_friend = get_user(db, request_data['to_user_id'])
         socketio.emit('friend_request_accepted', {
-            'friend': dict(new_friend)
+            'friend': plain(new_friend)
         }, room=request_data['from_user_id'])
     
     # Update request status
     db.execute('UPDATE friend_requests SET status = ? WHERE id = ?', 
                ('accepted' if accept else 'declined', request_id))
+    record_change(db, 'user', request_data['to_user_id'], 'friend_request', str(request_id))
     db.commit()
-    db.close()
     
     return jsonify({'success': True, 'message': 'Friend request ' + ('accepted' if accept else 'declined')})
 
@@ -1327,12 +3021,11 @@ def api_create_conversation():
     ''', (user_id, friend_id)).fetchone()
     
     if existing_conv:
-        db.close()
         return jsonify({'success': True, 'conversation_id': existing_conv['id']})
     
     # Create new conversation
-    conv_id = str(uuid.uuid4())
-    friend_user = db.execute('SELECT display_name FROM users WHERE id = ?', (friend_id,)).fetchone()
+    conv_id = str(id_generator.next())
+    friend_user = get_user(db, friend_id)
     conv_name = f"Chat with {friend_user['display_name']}"
     
     db.execute('INSERT INTO conversations (id, name, is_group, created_by, created_at) VALUES (?, ?, ?, ?, ?)',
@@ -1341,9 +3034,13 @@ def api_create_conversation():
     # Add participants
     db.execute('INSERT INTO conversation_participants (conversation_id, user_id) VALUES (?, ?)', (conv_id, user_id))
     db.execute('INSERT INTO conversation_participants (conversation_id, user_id) VALUES (?, ?)', (conv_id, friend_id))
+    record_change(db, 'conversation', conv_id, 'conversation', conv_id)
     
     db.commit()
-    db.close()
+    invalidate_participants(conv_id)
+    
+    add_to_conversation_room(conv_id, user_id)
+    add_to_conversation_room(conv_id, friend_id)
     
     return jsonify({'success': True, 'conversation_id': conv_id})
 
@@ -1357,20 +3054,19 @@ def api_start_call():
     db = get_db()
     
     # Get conversation participants
-    participants = db.execute('SELECT user_id FROM conversation_participants WHERE conversation_id = ? AND user_id != ?',
-                             (conversation_id, from_user_id)).fetchall()
+    participants = [user_id for user_id in get_participants(db, conversation_id) if user_id != from_user_id]
     
     if not participants:
         return jsonify({'success': False, 'error': 'No participants found'})
     
     # Create call record
-    call_id = str(uuid.uuid4())
+    call_id = str(id_generator.next())
     db.execute('INSERT INTO active_calls (id, from_user_id, to_user_id, conversation_id, call_type, status, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
-               (call_id, from_user_id, participants[0]['user_id'], conversation_id, call_type, 'ringing', datetime.now().isoformat()))
+               (int(call_id), from_user_id, participants[0], conversation_id, call_type, 'ringing', datetime.now().isoformat()))
     db.commit()
     
     # Get caller info
-    caller = db.execute('SELECT * FROM users WHERE id = ?', (from_user_id,)).fetchone()
+    caller = get_user(db, from_user_id)
     
     # Notify recipient
     socketio.emit('incoming_call', {
@@ -1379,10 +3075,9 @@ def api_start_call():
             'type': call_type,
             'conversation_id': conversation_id
         },
-        'caller': dict(caller)
-    }, room=participants[0]['user_id'])
+        'caller': plain(caller)
+    }, room=participants[0])
     
-    db.close()
     return jsonify({'success': True, 'call': {'id': call_id, 'type': call_type}})
 
 @app.route('/api/answer_call', methods=['POST'])
@@ -1393,25 +3088,24 @@ def api_answer_call():
     
     db = get_db()
     
-    call = db.execute('SELECT * FROM active_calls WHERE id = ?', (call_id,)).fetchone()
+    call = db.execute('SELECT * FROM active_calls WHERE id = ?', (parse_id(call_id),)).fetchone()
     if not call:
         return jsonify({'success': False, 'error': 'Call not found'})
     
     if accept:
-        db.execute('UPDATE active_calls SET status = ? WHERE id = ?', ('active', call_id))
+        db.execute('UPDATE active_calls SET status = ? WHERE id = ?', ('active', parse_id(call_id)))
         # Notify caller
         socketio.emit('call_accepted', {
             'call_id': call_id
         }, room=call['from_user_id'])
     else:
-        db.execute('UPDATE active_calls SET status = ? WHERE id = ?', ('declined', call_id))
+        db.execute('UPDATE active_calls SET status = ? WHERE id = ?', ('declined', parse_id(call_id)))
         # Notify caller
         socketio.emit('call_ended', {
             'call_id': call_id
         }, room=call['from_user_id'])
     
     db.commit()
-    db.close()
     return jsonify({'success': True})
 
 @app.route('/api/end_call', methods=['POST'])
@@ -1421,7 +3115,7 @@ def api_end_call():
     
     db = get_db()
     
-    call = db.execute('SELECT * FROM active_calls WHERE id = ?', (call_id,)).fetchone()
+    call = db.execute('SELECT * FROM active_calls WHERE id = ?', (parse_id(call_id),)).fetchone()
     if call:
         # Notify other participant
         other_user = call['to_user_id']
@@ -1429,49 +3123,152 @@ def api_end_call():
             'call_id': call_id
         }, room=other_user)
         
-        db.execute('DELETE FROM active_calls WHERE id = ?', (call_id,))
+        db.execute('DELETE FROM active_calls WHERE id = ?', (parse_id(call_id),))
         db.commit()
     
-    db.close()
     return jsonify({'success': True})
 
+@app.route('/api/metrics')
+def api_metrics():
+    return jsonify({
+        'success': True,
+        'db_executor': db_executor.stats(),
+        'message_cache': message_cache.stats(),
+        'user_cache': user_cache.stats(),
+        'participant_cache': participant_cache.stats(),
+        'archive_cache': message_archive.blocks.stats()
+    })
+
 # WebSocket events
 @socketio.on('connect')
 def handle_connect():
     user_id = request.args.get('user_id')
     if user_id:
         join_room(user_id)
-        db = get_db()
-        db.execute('UPDATE users SET online = 1 WHERE id = ?', (user_id,))
-        db.commit()
-        db.close()
+        join_conversation_rooms(get_db(), user_id, request.sid)
+        presence.start()
+        presence.connect(user_id, request.sid)
+        delivery.start(user_id, request.sid)
         print(f"User {user_id} connected")
 
 @socketio.on('disconnect')
 def handle_disconnect():
     user_id = request.args.get('user_id')
     if user_id:
-        db = get_db()
-        db.execute('UPDATE users SET online = 0 WHERE id = ?', (user_id,))
-        db.commit()
-        db.close()
+        presence.disconnect(user_id, request.sid)
+        delivery.stop(request.sid)
         print(f"User {user_id} disconnected")
 
 @socketio.on('send_message')
 def handle_send_message(data):
-    # Broadcast to conversation participants (already handled in API)
-    pass
+    # The return value is delivered to the client as the acknowledgement
+    user_id = request.args.get('user_id')
+    if not user_id:
+        return {'success': False, 'error': 'Not logged in'}
+    if not data or not data.get('conversation_id') or not data.get('content'):
+        return {'success': False, 'error': 'Missing data'}
+    
+    try:
+        message = deliver_message(dict(data, user_id=user_id))
+    except sqlite3.Error as e:
+        return {'success': False, 'error': str(e)}
+    
+    return {'success': True, 'id': message['id'], 'timestamp': message['timestamp'], 'seq': message['seq']}
+
+@socketio.on('messages_delivered')
+def handle_messages_delivered(data):
+    # Clients ack live new_message events by seq, plus the newest seq per
+    # conversation for delivered receipts. Until the replay for this socket
+    # has caught up, acks could skip messages it has yet to send.
+    user_id = request.args.get('user_id')
+    if not user_id or not data or delivery.is_replaying(request.sid):
+        return
+    try:
+        seq = int(data.get('seq'))
+        latest = {conversation_id: int(conversation_seq)
+                  for conversation_id, conversation_seq in (data.get('conversations') or {}).items()}
+    except (TypeError, ValueError, AttributeError):
+        return
+    db = get_db()
+    delivery.advance(db, user_id, seq)
+    for conversation_id, conversation_seq in latest.items():
+        if user_id in get_participants(db, conversation_id):
+            receipts.delivered(conversation_id, user_id, conversation_seq)
+
+@socketio.on('messages_read')
+def handle_messages_read(data):
+    # The client has shown the conversation up to seq
+    user_id = request.args.get('user_id')
+    if not user_id or not data or not data.get('conversation_id'):
+        return
+    try:
+        seq = int(data.get('seq'))
+    except (TypeError, ValueError):
+        return
+    if user_id not in get_participants(get_db(), data['conversation_id']):
+        return
+    receipts.read(data['conversation_id'], user_id, seq)
+
+@socketio.on('typing')
+def handle_typing(data):
+    user_id = request.args.get('user_id')
+    if not user_id or not data or not data.get('conversation_id'):
+        return
+    if user_id not in get_participants(get_db(), data['conversation_id']):
+        return
+    typing_relay.note(user_id, data['conversation_id'], bool(data.get('typing')))
 
 @socketio.on('user_status')
 def handle_user_status(data):
     # Update user status
     user_id = request.args.get('user_id')
     if user_id:
-        db = get_db()
-        db.execute('UPDATE users SET online = ? WHERE id = ?', (data['online'], user_id))
-        db.commit()
-        db.close()
+        presence.set_status(user_id, request.sid, data.get('online'))
+
+# Lifecycle
+def create_app():
+    # WSGI entry point for gunicorn (see gunicorn.conf.py). Importing
+    # the module has no side effects on the database; migrations run once in
+    # the gunicorn master via `python app.py init-db`.
+    cluster.start()
+    archiver.start()
+    return app
+
+def drain():
+    # Close every Engine.IO connection. Clients see a transport close, not a
+    # Socket.IO disconnect, so they reconnect (to another worker if any).
+    socketio.server.eio.disconnect()
+
+def shutdown():
+    # Write out what is still only held in memory and release the database
+    for writer in message_writers:
+        writer.flush()
+    for pending in (presence, receipts):
+        try:
+            pending.flush()
+        except sqlite3.Error as e:
+            print(f"Shutdown flush failed: {e}")
+    db_pool.close_all()
+    message_shards.close_all()
+    message_archive.close_all()
 
 if __name__ == '__main__':
+    if sys.argv[1:2] == ['broker']:
+        # python app.py broker [socket path]: run the local pub/sub broker
+        LocalBroker(sys.argv[2] if len(sys.argv) > 2 else '/tmp/nos-mobile-pubsub.sock').serve_forever()
+    init_db()
+    if sys.argv[1:2] == ['init-db']:
+        # python app.py init-db: apply migrations and reset presence, then exit
+        sys.exit(0)
+    if sys.argv[1:2] == ['archive']:
+        # python app.py archive: archive cold months now (e.g. from cron)
+        archiver.run()
+        sys.exit(0)
+    # Development server; use gunicorn -c gunicorn.conf.py in production
     port = int(os.environ.get('PORT', 5000))
-    socketio.run(app, host='0.0.0.0', port=port, debug=False, allow_unsafe_werkzeug=True)
+    cluster.start()
+    archiver.start()
+    try:
+        socketio.run(app, host='0.0.0.0', port=port, debug=False, allow_unsafe_werkzeug=True)
+    finally:
+        shutdown()
@@ -0,0 +1,44 @@
+# Production server: gunicorn -c gunicorn.conf.py
+import os
+import signal
+import subprocess
+import sys
+
+wsgi_app = 'app:create_app()'
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+
+# Every open socket holds one green thread, so worker_connections caps the
+# number of connected clients per worker. More than one worker needs
+# SOCKETIO_MESSAGE_QUEUE and sticky sessions (see README).
+worker_class = 'eventlet'
+workers = int(os.environ.get('WEB_CONCURRENCY', 1))
+worker_connections = int(os.environ.get('WORKER_CONNECTIONS', 1000))
+keepalive = int(os.environ.get('KEEPALIVE', 5))
+timeout = int(os.environ.get('TIMEOUT', 30))
+# How long a stopping worker may take to drain sockets and flush writes
+graceful_timeout = int(os.environ.get('GRACEFUL_TIMEOUT', 10))
+
+accesslog = os.environ.get('ACCESS_LOG')
+errorlog = '-'
+
+def on_starting(server):
+    # Migrate once, in a separate process, before any worker imports the app
+    here = os.path.dirname(os.path.abspath(__file__))
+    subprocess.run([sys.executable, os.path.join(here, 'app.py'), 'init-db'], check=True)
+
+def post_worker_init(worker):
+    # gunicorn only stops accepting on SIGTERM and then waits for open
+    # connections, which for websockets means waiting out graceful_timeout.
+    # Close them right away so clients reconnect elsewhere.
+    import eventlet
+    import app
+
+    def handle_exit(sig, frame):
+        worker.alive = False
+        eventlet.spawn(app.drain)
+
+    signal.signal(signal.SIGTERM, handle_exit)
+
+def worker_exit(server, worker):
+    import app
+    app.shutdown()
@@ -0,0 +1,856 @@
+let currentUser = null;
+let socket = null;
+let currentConversation = null;
+let currentCall = null;
+let conversations = [];
+let friends = [];
+let friendRequests = [];
+let olderMessagesCursor = null;
+let hasOlderMessages = false;
+let loadingOlderMessages = false;
+const MESSAGE_PAGE_SIZE = 50;
+let syncCursor = 0;
+let syncing = false;
+let syncPending = false;
+let currentTab = 'chats';
+let deliveredSeq = 0;
+let deliveredByConversation = {};
+let deliveryAckTimer = null;
+const DELIVERY_ACK_DELAY = 500;
+// conversation id -> user id -> {delivered_seq, read_seq}
+let conversationReceipts = {};
+let readByConversation = {};
+let readAckTimer = null;
+// conversation id -> user id -> time the indicator expires
+let typingUsers = {};
+let typingConversationId = null;
+let typingSentAt = 0;
+let typingStopTimer = null;
+const TYPING_REFRESH = 3000;
+const TYPING_IDLE = 3000;
+const TYPING_TIMEOUT = 6000;
+let searchQuery = '';
+let searchTimer = null;
+let searchResults = [];
+let searchNextOffset = null;
+const SEARCH_DELAY = 250;
+const MESSAGE_PREVIEW_LENGTH = 120;
+
+// Initialize app
+function initApp() {
+    const savedUser = localStorage.getItem('whatsappUser');
+    if (savedUser) {
+        currentUser = JSON.parse(savedUser);
+        showApp();
+        connectSocket();
+        loadData();
+    }
+}
+
+function login() {
+    const username = document.getElementById('usernameInput').value.trim();
+    if (!username) {
+        alert('Please enter your name');
+        return;
+    }
+
+    fetch('/api/login', {
+        method: 'POST',
+        headers: {'Content-Type': 'application/json'},
+        body: JSON.stringify({username: username})
+    })
+    .then(r => r.json())
+    .then(data => {
+        if (data.success) {
+            currentUser = data.user;
+            localStorage.setItem('whatsappUser', JSON.stringify(data.user));
+            showApp();
+            connectSocket();
+            loadData();
+        } else {
+            alert('Error: ' + data.error);
+        }
+    });
+}
+
+function showApp() {
+    document.getElementById('loginScreen').style.display = 'none';
+    document.getElementById('appContainer').style.display = 'flex';
+
+    document.getElementById('userName').textContent = currentUser.display_name;
+    document.getElementById('userAvatar').textContent = currentUser.display_name.charAt(0).toUpperCase();
+    document.getElementById('userAvatar').style.background = currentUser.avatar_color;
+    document.getElementById('userCode').textContent = 'CODE: ' + currentUser.user_code;
+    document.getElementById('userStatus').textContent = 'Online';
+}
+
+function connectSocket() {
+    // Transport profile from the server (WebSocket first, polling as fallback)
+    socket = io(Object.assign({}, window.SOCKET_OPTIONS, {query: {user_id: currentUser.id}}));
+
+    socket.on('connect', () => {
+        console.log('Connected to server');
+        updateOnlineStatus(true);
+    });
+
+    socket.on('new_message', handleNewMessage);
+    socket.on('missed_messages', handleMissedMessages);
+    socket.on('receipts', handleReceipts);
+    socket.on('presence', handlePresence);
+    socket.on('typing', handleTyping);
+    socket.on('friend_request', handleFriendRequest);
+    socket.on('friend_request_accepted', handleFriendRequestAccepted);
+    socket.on('incoming_call', handleIncomingCall);
+    socket.on('call_accepted', handleCallAccepted);
+    socket.on('call_ended', handleCallEnded);
+}
+
+function loadData() {
+    syncData();
+}
+
+// Fetch only what changed since the last sync cursor and merge it in
+function syncData() {
+    if (syncing) {
+        syncPending = true;
+        return;
+    }
+    syncing = true;
+
+    fetch('/api/sync?user_id=' + currentUser.id + '&since=' + syncCursor)
+    .then(r => r.json())
+    .then(data => {
+        syncing = false;
+        if (!data.success) return;
+
+        if (data.reset) {
+            conversations = data.conversations;
+            friends = data.friends;
+            friendRequests = data.friend_requests;
+        } else {
+            conversations = mergeById(conversations, data.conversations);
+            friends = mergeById(friends, data.friends);
+            friendRequests = mergeById(friendRequests, data.friend_requests)
+                .filter(req => !data.removed_friend_requests.includes(req.id));
+        }
+        conversations.sort((a, b) => (b.last_message_at || '').localeCompare(a.last_message_at || ''));
+
+        data.messages.forEach(msg => {
+            if (currentConversation && msg.conversation_id === currentConversation.id) {
+                addMessageToUI(msg, msg.user_id === currentUser.id);
+            }
+        });
+
+        syncCursor = data.cursor;
+        renderCurrentTab();
+        if (data.has_more || syncPending) {
+            syncPending = false;
+            syncData();
+        }
+    })
+    .catch(() => {
+        syncing = false;
+    });
+}
+
+function mergeById(items, updates) {
+    const byId = new Map(items.map(item => [item.id, item]));
+    updates.forEach(item => byId.set(item.id, item));
+    return Array.from(byId.values());
+}
+
+function renderCurrentTab() {
+    if (searchQuery) {
+        renderSearchResults();
+    } else if (currentTab === 'chats') {
+        renderConversations();
+    } else if (currentTab === 'friends') {
+        renderFriends();
+    } else if (currentTab === 'requests') {
+        renderFriendRequests();
+    }
+}
+
+function renderConversations() {
+    const container = document.getElementById('contentArea');
+    container.innerHTML = conversations.map(conv => `
+        <div class="conversation-item" onclick="selectConversation('${conv.id}')">
+            <div class="item-avatar" style="background: ${conv.avatar_color || '#4ECDC4'};">${conv.name.charAt(0).toUpperCase()}</div>
+            <div class="item-info">
+                <div class="item-name">${conv.name}</div>
+                <div class="item-preview">${conv.last_message || 'No messages yet'}</div>
+            </div>
+        </div>
+    `).join('');
+}
+
+function renderFriends() {
+    const container = document.getElementById('contentArea');
+    container.innerHTML = friends.map(friend => `
+        <div class="friend-item" onclick="startChatWithFriend('${friend.id}')">
+            <div class="item-avatar" style="background: ${friend.avatar_color || '#45B7D1'};">${friend.display_name.charAt(0).toUpperCase()}</div>
+            <div class="item-info">
+                <div class="item-name">${friend.display_name}</div>
+                <div class="item-status">${friend.online ? 'Online' : 'Offline'}</div>
+                <div class="item-preview">Code: ${friend.user_code}</div>
+            </div>
+        </div>
+    `).join('');
+}
+
+function renderFriendRequests() {
+    const container = document.getElementById('contentArea');
+    if (friendRequests.length === 0) {
+        container.innerHTML = '<div style="text-align: center; color: #8696a0; padding: 40px;">No pending friend requests</div>';
+        return;
+    }
+
+    container.innerHTML = friendRequests.map(req => `
+        <div class="friend-request-item">
+            <div class="item-avatar" style="background: ${req.from_avatar_color || '#FF6B6B'};">${req.from_display_name.charAt(0).toUpperCase()}</div>
+            <div class="item-info">
+                <div class="item-name">${req.from_display_name}</div>
+                <div class="item-preview">Wants to be your friend</div>
+            </div>
+            <div class="request-actions">
+                <button class="accept-btn" onclick="respondToRequest('${req.id}', true)">Accept</button>
+                <button class="decline-btn" onclick="respondToRequest('${req.id}', false)">Decline</button>
+            </div>
+        </div>
+    `).join('');
+}
+
+// Message search: results replace the tab list while there is a query
+function onSearchInput() {
+    clearTimeout(searchTimer);
+    searchTimer = setTimeout(() => {
+        searchQuery = document.getElementById('searchInput').value.trim();
+        searchResults = [];
+        searchNextOffset = null;
+        if (searchQuery) {
+            searchMessages(0);
+        } else {
+            renderCurrentTab();
+        }
+    }, SEARCH_DELAY);
+}
+
+function searchMessages(offset) {
+    const query = searchQuery;
+    fetch('/api/search?user_id=' + currentUser.id + '&q=' + encodeURIComponent(query) + '&offset=' + offset)
+    .then(r => r.json())
+    .then(data => {
+        // Ignore answers for a query the user has typed past
+        if (!data.success || query !== searchQuery) return;
+        searchResults = offset ? searchResults.concat(data.results) : data.results;
+        searchNextOffset = data.next_offset;
+        renderSearchResults();
+    });
+}
+
+function renderSearchResults() {
+    const container = document.getElementById('contentArea');
+    if (searchResults.length === 0) {
+        container.innerHTML = '<div style="text-align: center; color: #8696a0; padding: 40px;">No messages found</div>';
+        return;
+    }
+
+    // Snippets arrive escaped, with matches wrapped in <mark>
+    container.innerHTML = searchResults.map(result => {
+        const conv = conversations.find(c => c.id === result.conversation_id) || {name: 'Chat'};
+        return `
+            <div class="conversation-item" onclick="selectConversation('${result.conversation_id}')">
+                <div class="item-avatar" style="background: ${conv.avatar_color || '#4ECDC4'};">${conv.name.charAt(0).toUpperCase()}</div>
+                <div class="item-info">
+                    <div class="item-name">${conv.name}</div>
+                    <div class="item-preview">${result.display_name}: ${result.snippet}</div>
+                </div>
+            </div>
+        `;
+    }).join('') + (searchNextOffset !== null
+        ? `<div class="load-more" onclick="searchMessages(${searchNextOffset})">More results</div>` : '');
+}
+
+function switchTab(tabName) {
+    document.querySelectorAll('.tab').forEach(tab => tab.classList.remove('active'));
+    event.target.classList.add('active');
+
+    currentTab = tabName;
+    renderCurrentTab();
+}
+
+function selectConversation(conversationId) {
+    stopTyping();
+    currentConversation = conversations.find(c => c.id === conversationId);
+    if (!currentConversation) return;
+
+    document.getElementById('chatName').textContent = currentConversation.name;
+    document.getElementById('chatAvatar').textContent = currentConversation.name.charAt(0).toUpperCase();
+    document.getElementById('chatAvatar').style.background = currentConversation.avatar_color || '#4ECDC4';
+    renderChatStatus();
+    document.getElementById('chatActions').style.display = 'flex';
+    document.getElementById('inputContainer').style.display = 'flex';
+
+    olderMessagesCursor = null;
+    hasOlderMessages = false;
+    loadMessages(conversationId);
+}
+
+function loadMessages(conversationId, before) {
+    let url = '/api/messages/' + conversationId + '?limit=' + MESSAGE_PAGE_SIZE;
+    if (before) {
+        url += '&before=' + encodeURIComponent(before);
+    }
+
+    loadingOlderMessages = true;
+    fetch(url)
+    .then(r => r.json())
+    .then(data => {
+        loadingOlderMessages = false;
+        // Ignore pages for a chat the user has already left
+        if (!currentConversation || currentConversation.id !== conversationId) return;
+        if (data.success) {
+            olderMessagesCursor = data.before_cursor;
+            hasOlderMessages = data.has_more;
+            mergeReceipts(conversationId, data.receipts);
+            renderMessages(data.messages, !!before);
+            if (!before && data.messages.length) {
+                markRead(conversationId, data.messages[data.messages.length - 1].seq);
+            }
+        }
+    })
+    .catch(() => {
+        loadingOlderMessages = false;
+    });
+}
+
+function loadOlderMessages() {
+    if (!currentConversation || !hasOlderMessages || loadingOlderMessages) return;
+    loadMessages(currentConversation.id, olderMessagesCursor);
+}
+
+function renderMessages(messages, prepend) {
+    const container = document.getElementById('messagesContainer');
+    const html = messages.map(msg => `
+        <div class="message ${msg.user_id === currentUser.id ? 'sent' : 'received'}" data-id="${msg.id}" data-seq="${msg.seq || ''}">
+            <div class="message-content">${msg.content}</div>
+            <div class="message-time">${formatTime(msg.timestamp)}${msg.user_id === currentUser.id ? messageStatusHTML(msg.seq) : ''}</div>
+        </div>
+    `).join('');
+
+    if (prepend) {
+        // Keep the current viewport in place while older history is inserted above it
+        const previousHeight = container.scrollHeight;
+        container.insertAdjacentHTML('afterbegin', html);
+        container.scrollTop += container.scrollHeight - previousHeight;
+    } else {
+        container.innerHTML = html;
+        container.scrollTop = container.scrollHeight;
+    }
+}
+
+function sendMessage() {
+    const input = document.getElementById('messageInput');
+    const content = input.value.trim();
+
+    if (!content || !currentConversation) return;
+
+    const messageData = {
+        id: 'msg_' + Date.now(),
+        conversation_id: currentConversation.id,
+        user_id: currentUser.id,
+        content: content,
+        timestamp: new Date().toISOString()
+    };
+
+    // Add to UI immediately
+    addMessageToUI(messageData, true);
+    input.value = '';
+    stopTyping();
+
+    // Send over the socket when connected; the ack carries the stored id/seq
+    if (socket && socket.connected) {
+        socket.emit('send_message', messageData, ack => {
+            if (!ack || !ack.success) {
+                alert('Message not sent: ' + (ack ? ack.error : 'no response'));
+                return;
+            }
+            confirmMessage(messageData.id, ack);
+        });
+    } else {
+        fetch('/api/send_message', {
+            method: 'POST',
+            headers: {'Content-Type': 'application/json'},
+            body: JSON.stringify(messageData)
+        })
+        .then(r => r.json())
+        .then(data => {
+            if (!data.success) {
+                alert('Message not sent: ' + data.error);
+                return;
+            }
+            confirmMessage(messageData.id, data.message);
+        });
+    }
+}
+
+function addMessageToUI(messageData, isSent) {
+    const container = document.getElementById('messagesContainer');
+    const placeholder = container.querySelector('div[style]');
+    if (placeholder) placeholder.remove();
+
+    // The same message can arrive over the socket and from a sync
+    if (messageData.id && container.querySelector(`[data-id="${CSS.escape(messageData.id)}"]`)) return;
+
+    const messageDiv = document.createElement('div');
+    messageDiv.className = `message ${isSent ? 'sent' : 'received'}`;
+    if (messageData.id) messageDiv.dataset.id = messageData.id;
+    messageDiv.dataset.seq = messageData.seq || '';
+    messageDiv.innerHTML = `
+        <div class="message-content">${messageData.content}</div>
+        <div class="message-time">${formatTime(messageData.timestamp)}${isSent ? messageStatusHTML(messageData.seq) : ''}</div>
+    `;
+
+    container.appendChild(messageDiv);
+    container.scrollTop = container.scrollHeight;
+}
+
+function handleNewMessage(data) {
+    applyIncomingMessage(data.message);
+    acknowledgeDelivery(data.message);
+}
+
+// Messages sent while we were offline, replayed by the server in batches.
+// Acking a batch advances our delivery cursor and asks for the next one.
+function handleMissedMessages(batch, ack) {
+    batch.messages.forEach(applyIncomingMessage);
+    if (ack) ack();
+}
+
+function applyIncomingMessage(msg) {
+    if (currentConversation && msg.conversation_id === currentConversation.id) {
+        // Our own messages sent from another tab can come back via another worker
+        addMessageToUI(msg, msg.user_id === currentUser.id);
+        markRead(msg.conversation_id, msg.seq);
+    }
+
+    const conv = conversations.find(c => c.id === msg.conversation_id);
+    if (!conv) {
+        // A chat we have not seen yet
+        syncData();
+        return;
+    }
+    if ((conv.last_message_at || '') <= msg.timestamp) {
+        conv.last_message = conv.last_message_preview = (msg.content || '').slice(0, MESSAGE_PREVIEW_LENGTH);
+        conv.last_message_at = msg.timestamp;
+        conv.last_message_id = msg.id;
+        conversations.sort((a, b) => (b.last_message_at || '').localeCompare(a.last_message_at || ''));
+        if (currentTab === 'chats') renderConversations();
+    }
+}
+
+// Live messages are acked by their delivery seq, coalesced into one emit
+// that also carries the newest seq per conversation for delivered receipts
+function acknowledgeDelivery(msg) {
+    if (!msg.seq) return;
+    deliveredSeq = Math.max(deliveredSeq, msg.seq);
+    deliveredByConversation[msg.conversation_id] = Math.max(deliveredByConversation[msg.conversation_id] || 0, msg.seq);
+    if (deliveryAckTimer) return;
+    deliveryAckTimer = setTimeout(() => {
+        deliveryAckTimer = null;
+        if (socket && socket.connected) {
+            socket.emit('messages_delivered', {seq: deliveredSeq, conversations: deliveredByConversation});
+        }
+        deliveredByConversation = {};
+    }, DELIVERY_ACK_DELAY);
+}
+
+// Read receipts: remember the newest seq shown per conversation and send
+// them together, only while the page is actually visible
+function markRead(conversationId, seq) {
+    if (!seq) return;
+    readByConversation[conversationId] = Math.max(readByConversation[conversationId] || 0, seq);
+    if (readAckTimer || document.visibilityState !== 'visible') return;
+    readAckTimer = setTimeout(() => {
+        readAckTimer = null;
+        if (socket && socket.connected) {
+            Object.keys(readByConversation).forEach(id => {
+                socket.emit('messages_read', {conversation_id: id, seq: readByConversation[id]});
+            });
+            readByConversation = {};
+        }
+    }, DELIVERY_ACK_DELAY);
+}
+
+document.addEventListener('visibilitychange', () => {
+    if (document.visibilityState === 'visible' && currentConversation) {
+        const seqs = Array.from(document.querySelectorAll('#messagesContainer [data-seq]'))
+            .map(el => Number(el.dataset.seq) || 0);
+        markRead(currentConversation.id, Math.max(0, ...seqs));
+    }
+});
+
+function mergeReceipts(conversationId, updates) {
+    const receipts = conversationReceipts[conversationId] || (conversationReceipts[conversationId] = {});
+    (updates || []).forEach(r => {
+        const known = receipts[r.user_id] || {delivered_seq: 0, read_seq: 0};
+        receipts[r.user_id] = {
+            delivered_seq: Math.max(known.delivered_seq, r.delivered_seq),
+            read_seq: Math.max(known.read_seq, r.read_seq)
+        };
+    });
+}
+
+function handleReceipts(data) {
+    mergeReceipts(data.conversation_id, data.receipts);
+    if (currentConversation && data.conversation_id === currentConversation.id) {
+        updateMessageStatuses();
+    }
+}
+
+// Ticks for our own messages: one when stored, two when every other
+// participant has it, blue when every other participant has read it
+function messageStatus(seq) {
+    if (!seq || !currentConversation) return '';
+    const receipts = conversationReceipts[currentConversation.id] || {};
+    const others = Object.keys(receipts).filter(id => id !== currentUser.id).map(id => receipts[id]);
+    if (others.length && others.every(r => r.read_seq >= seq)) return 'read';
+    if (others.length && others.every(r => r.delivered_seq >= seq)) return 'delivered';
+    return 'sent';
+}
+
+function messageStatusHTML(seq) {
+    const status = messageStatus(seq);
+    if (!status) return '';
+    return ` <span class="message-status ${status}">${status === 'sent' ? '✓' : '✓✓'}</span>`;
+}
+
+function updateMessageStatuses() {
+    document.querySelectorAll('#messagesContainer .message.sent').forEach(el => {
+        const time = el.querySelector('.message-time');
+        const old = time.querySelector('.message-status');
+        if (old) old.remove();
+        time.insertAdjacentHTML('beforeend', messageStatusHTML(Number(el.dataset.seq)));
+    });
+}
+
+// The server assigns the real id; swap it in for the placeholder so the
+// copy that later arrives through a sync is recognised as the same message
+function confirmMessage(placeholderId, stored) {
+    const el = document.querySelector(`#messagesContainer [data-id="${CSS.escape(placeholderId)}"]`);
+    if (!el) return;
+    if (stored.id) el.dataset.id = stored.id;
+    if (stored.seq) el.dataset.seq = stored.seq;
+    updateMessageStatuses();
+}
+
+function showAddFriend() {
+    const userCode = prompt("Enter friend's code:");
+    if (userCode) {
+        fetch('/api/send_friend_request', {
+            method: 'POST',
+            headers: {'Content-Type': 'application/json'},
+            body: JSON.stringify({
+                from_user_id: currentUser.id,
+                to_user_code: userCode
+            })
+        })
+        .then(r => r.json())
+        .then(data => {
+            if (data.success) {
+                alert('Friend request sent!');
+                syncData();
+            } else {
+                alert('Error: ' + data.error);
+            }
+        });
+    }
+}
+
+function respondToRequest(requestId, accept) {
+    fetch('/api/respond_friend_request', {
+        method: 'POST',
+        headers: {'Content-Type': 'application/json'},
+        body: JSON.stringify({
+            request_id: requestId,
+            accept: accept
+        })
+    })
+    .then(r => r.json())
+    .then(data => {
+        if (data.success) {
+            syncData();
+            if (accept) {
+                alert('Friend added successfully!');
+            }
+        }
+    });
+}
+
+function handleFriendRequest(data) {
+    syncData();
+    alert(`New friend request from ${data.from_user.display_name}`);
+}
+
+function handleFriendRequestAccepted(data) {
+    syncData();
+    alert(`${data.friend.display_name} accepted your friend request!`);
+}
+
+function startChatWithFriend(friendId) {
+    fetch('/api/create_conversation', {
+        method: 'POST',
+        headers: {'Content-Type': 'application/json'},
+        body: JSON.stringify({
+            user_id: currentUser.id,
+            friend_id: friendId
+        })
+    })
+    .then(r => r.json())
+    .then(data => {
+        if (data.success) {
+            syncData();
+            // Switch to chats tab and select the conversation
+            document.querySelectorAll('.tab')[0].click();
+            // You might want to automatically select the new conversation here
+        }
+    });
+}
+
+function startVoiceCall() {
+    if (!currentConversation) return;
+
+    fetch('/api/start_call', {
+        method: 'POST',
+        headers: {'Content-Type': 'application/json'},
+        body: JSON.stringify({
+            from_user_id: currentUser.id,
+            conversation_id: currentConversation.id,
+            call_type: 'voice'
+        })
+    })
+    .then(r => r.json())
+    .then(data => {
+        if (data.success) {
+            currentCall = data.call;
+            showCallInterface('outgoing');
+        }
+    });
+}
+
+function startVideoCall() {
+    if (!currentConversation) return;
+
+    fetch('/api/start_call', {
+        method: 'POST',
+        headers: {'Content-Type': 'application/json'},
+        body: JSON.stringify({
+            from_user_id: currentUser.id,
+            conversation_id: currentConversation.id,
+            call_type: 'video'
+        })
+    })
+    .then(r => r.json())
+    .then(data => {
+        if (data.success) {
+            currentCall = data.call;
+            showCallInterface('outgoing');
+        }
+    });
+}
+
+function handleIncomingCall(data) {
+    currentCall = data.call;
+    document.getElementById('callerName').textContent = data.caller.display_name;
+    document.getElementById('callStatus').textContent = `Incoming ${data.call.call_type} call`;
+    showCallInterface('incoming');
+}
+
+function showCallInterface(type) {
+    const callInterface = document.getElementById('callInterface');
+    const acceptBtn = callInterface.querySelector('.accept-call');
+    const declineBtn = callInterface.querySelector('.decline-call');
+    const endBtn = callInterface.querySelector('.end-call');
+
+    if (type === 'incoming') {
+        acceptBtn.style.display = 'flex';
+        declineBtn.style.display = 'flex';
+        endBtn.style.display = 'none';
+        document.getElementById('callStatus').textContent = 'Incoming call';
+    } else {
+        acceptBtn.style.display = 'none';
+        declineBtn.style.display = 'none';
+        endBtn.style.display = 'flex';
+        document.getElementById('callStatus').textContent = 'Calling...';
+    }
+
+    callInterface.style.display = 'flex';
+}
+
+function answerCall(accept) {
+    if (!currentCall) return;
+
+    fetch('/api/answer_call', {
+        method: 'POST',
+        headers: {'Content-Type': 'application/json'},
+        body: JSON.stringify({
+            call_id: currentCall.id,
+            accept: accept
+        })
+    })
+    .then(r => r.json())
+    .then(data => {
+        if (data.success) {
+            if (accept) {
+                document.getElementById('callStatus').textContent = 'Call connected';
+                document.querySelector('.accept-call').style.display = 'none';
+                document.querySelector('.decline-call').style.display = 'none';
+                document.querySelector('.end-call').style.display = 'flex';
+            } else {
+                hideCallInterface();
+            }
+        }
+    });
+}
+
+function endCall() {
+    if (!currentCall) return;
+
+    fetch('/api/end_call', {
+        method: 'POST',
+        headers: {'Content-Type': 'application/json'},
+        body: JSON.stringify({
+            call_id: currentCall.id
+        })
+    })
+    .then(r => r.json())
+    .then(data => {
+        hideCallInterface();
+    });
+}
+
+function handleCallAccepted(data) {
+    document.getElementById('callStatus').textContent = 'Call connected';
+    document.querySelector('.accept-call').style.display = 'none';
+    document.querySelector('.decline-call').style.display = 'none';
+    document.querySelector('.end-call').style.display = 'flex';
+}
+
+function handleCallEnded(data) {
+    hideCallInterface();
+    alert('Call ended');
+}
+
+function hideCallInterface() {
+    document.getElementById('callInterface').style.display = 'none';
+    currentCall = null;
+}
+
+function formatTime(timestamp) {
+    const date = new Date(timestamp);
+    return date.toLocaleTimeString([], {hour: '2-digit', minute:'2-digit'});
+}
+
+// Online/offline pushes for friends (batched by the server)
+function handlePresence(data) {
+    data.users.forEach(update => {
+        const friend = friends.find(f => f.id === update.user_id);
+        if (friend) friend.online = update.online ? 1 : 0;
+    });
+    if (currentTab === 'friends') renderFriends();
+    renderChatStatus();
+}
+
+function handleTyping(data) {
+    const users = typingUsers[data.conversation_id] || (typingUsers[data.conversation_id] = {});
+    if (data.typing) {
+        users[data.user_id] = Date.now() + TYPING_TIMEOUT;
+        // Drop the indicator if no refresh arrives in time
+        setTimeout(renderChatStatus, TYPING_TIMEOUT + 50);
+    } else {
+        delete users[data.user_id];
+    }
+    renderChatStatus();
+}
+
+function renderChatStatus() {
+    if (!currentConversation) return;
+    const status = document.getElementById('chatStatus');
+    const users = typingUsers[currentConversation.id] || {};
+    const now = Date.now();
+    const typing = Object.keys(users).filter(id => users[id] > now);
+    if (typing.length) {
+        if (currentConversation.is_group) {
+            const names = typing.map(id => (friends.find(f => f.id === id) || {}).display_name || 'Someone');
+            status.textContent = names.join(', ') + (names.length > 1 ? ' are typing…' : ' is typing…');
+        } else {
+            status.textContent = 'typing…';
+        }
+        return;
+    }
+    if (currentConversation.is_group) {
+        status.textContent = '';
+        return;
+    }
+    const peer = friends.find(f => f.id === currentConversation.peer_id);
+    status.textContent = peer && peer.online ? 'Online' : 'Offline';
+}
+
+// Tell the chat we are typing: refreshed while keys keep coming, stopped
+// after a pause or when the message is sent
+function notifyTyping() {
+    if (!currentConversation || !socket || !socket.connected) return;
+    const now = Date.now();
+    if (typingConversationId !== currentConversation.id || now - typingSentAt >= TYPING_REFRESH) {
+        if (typingConversationId !== currentConversation.id) stopTyping();
+        socket.emit('typing', {conversation_id: currentConversation.id, typing: true});
+        typingConversationId = currentConversation.id;
+        typingSentAt = now;
+    }
+    clearTimeout(typingStopTimer);
+    typingStopTimer = setTimeout(stopTyping, TYPING_IDLE);
+}
+
+function stopTyping() {
+    clearTimeout(typingStopTimer);
+    typingStopTimer = null;
+    if (!typingConversationId) return;
+    if (socket && socket.connected) {
+        socket.emit('typing', {conversation_id: typingConversationId, typing: false});
+    }
+    typingConversationId = null;
+}
+
+function updateOnlineStatus(online) {
+    if (socket) {
+        socket.emit('user_status', {online: online});
+    }
+}
+
+// Auto-resize textarea and enter to send
+document.addEventListener('DOMContentLoaded', function() {
+    const textarea = document.getElementById('messageInput');
+    textarea.addEventListener('input', function() {
+        this.style.height = 'auto';
+        this.style.height = (this.scrollHeight) + 'px';
+        if (this.value) notifyTyping(); else stopTyping();
+    });
+
+    textarea.addEventListener('keypress', function(e) {
+        if (e.key === 'Enter' && !e.shiftKey) {
+            e.preventDefault();
+            sendMessage();
+        }
+    });
+
+    document.getElementById('searchInput').addEventListener('input', onSearchInput);
+
+    // Fetch older history when scrolled near the top
+    document.getElementById('messagesContainer').addEventListener('scroll', function() {
+        if (this.scrollTop < 100) {
+            loadOlderMessages();
+        }
+    });
+
+    initApp();
+});
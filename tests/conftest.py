@@ -0,0 +1,8 @@
+import os
+import sys
+import tempfile
+
+# app reads its settings at import time, so point it at a scratch database
+# before any test imports it
+os.environ['DATABASE'] = os.path.join(tempfile.mkdtemp(), 'test.db')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,29 @@
+import app
+
+
+def cached(cache, conversation_id):
+    messages, _ = cache.get(conversation_id, cache.size)
+    return [(m['id'], m.get('seq')) for m in messages]
+
+
+def test_append_after_fill_keeps_one_copy_with_seq():
+    # A fill can read a row the writer has committed but not yet given its
+    # seq; the writer's append for that row must replace it, not duplicate it
+    cache = app.MessageCache(size=5)
+    cache.begin_fill('c1')
+    cache.fill('c1', [{'id': '100', 'conversation_id': 'c1', 'content': 'hi', 'seq': None,
+                       'display_name': 'alice'}], has_older=False)
+    cache.append({'id': '100', 'conversation_id': 'c1', 'content': 'hi', 'seq': 7}, 'alice')
+
+    assert cached(cache, 'c1') == [('100', 7)]
+    assert cache.stats()['bytes'] == sum(cache._cost(m) for m in cache._entries['c1']['messages'])
+
+
+def test_append_keeps_id_order():
+    cache = app.MessageCache(size=3)
+    cache.begin_fill('c1')
+    cache.fill('c1', [], has_older=False)
+    for message_id in ('30', '10', '20', '40'):
+        cache.append({'id': message_id, 'conversation_id': 'c1', 'content': '', 'seq': int(message_id)}, 'alice')
+
+    assert [message_id for message_id, _ in cached(cache, 'c1')] == ['20', '30', '40']
@@ -0,0 +1,61 @@
+import threading
+
+import pytest
+
+import app
+
+
+@pytest.fixture(scope='module', autouse=True)
+def database():
+    app.init_db()
+    yield
+    app.message_shards.close_all()
+    app.db_pool.close_all()
+
+
+def traced_writer():
+    # A writer for shard 0 whose next pooled connection records every
+    # statement it runs
+    pool = app.message_shards.pools[0]
+    conn = pool.acquire()
+    statements = []
+    conn._conn.set_trace_callback(statements.append)
+    pool.release(conn)
+    return app.MessageWriter(pool, app.db_pool), statements
+
+
+def item(content):
+    message_id = app.id_generator.next()
+    message = {'id': str(message_id), 'conversation_id': 'c1', 'user_id': 'u1',
+               'content': content, 'timestamp': app.id_timestamp(message_id)}
+    return {'message': message, 'done': threading.Event(), 'error': None}
+
+
+def test_batch_is_one_transaction():
+    writer, statements = traced_writer()
+    batch = [item(f'message {n}') for n in range(3)]
+    writer._write(batch)
+
+    assert all(entry['error'] is None and entry['done'].is_set() for entry in batch)
+    assert all(entry['message']['seq'] for entry in batch)
+    # Everything up to the seq back-fill is the batch insert: it must open
+    # one transaction and commit it once
+    inserts = statements[:next(n for n, sql in enumerate(statements) if sql.startswith('UPDATE messages SET seq'))]
+    assert inserts[0] == 'BEGIN IMMEDIATE'
+    assert inserts.count('COMMIT') == 1
+    commit = inserts.index('COMMIT')
+    assert not [sql for sql in inserts[commit:] if sql.startswith(('INSERT', 'SAVEPOINT', 'RELEASE'))]
+
+
+def test_bad_row_does_not_fail_the_batch():
+    writer, _ = traced_writer()
+    good = item('fine')
+    duplicate = item('dup')
+    duplicate['message']['id'] = good['message']['id']
+    writer._write([good, duplicate])
+
+    assert good['error'] is None
+    assert duplicate['error'] is not None
+    with app.message_shards.pools[0].connection() as conn:
+        rows = conn.execute('SELECT content FROM messages WHERE id = ?', (int(good['message']['id']),)).fetchall()
+    assert [row['content'] for row in rows] == ['fine']